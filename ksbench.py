@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+"""Benchmarks for ksconveyor on synthetic belts
+
+Generates a belt with the same layout ksconveyor works on (parts/ and
+templates/ with relative symlinks), times loading, listing and
+assembling, and reports throughput and peak memory. Results can be saved
+as JSON baseline and compared against later:
+
+  $ ./ksbench.py --parts 5000 --templates 500 --save baseline.json
+  $ ./ksbench.py --parts 5000 --templates 500 --compare baseline.json
+"""
+
+from __future__ import print_function
+import sys
+import argparse
+import os
+import os.path
+import json
+import time
+import random
+import shutil
+import tempfile
+import resource
+import traceback
+
+import ksconveyor
+from ksconveyor import SECTIONS, KSAssembler
+
+# phases in the order they are run and reported
+PHASES=('conveyor','parts_load','templates_load','lstemplates','assemble')
+
+def make_belt(base_dir,parts=1000,templates=100,links=20,vars_per_part=5,part_size=1024,var_pool=200,seed=0):
+    """Generate synthetic belt in base_dir. Parts are spread evenly over
+    SECTIONS, every template links to `links` random parts. Returns
+    number of links created"""
+    rnd=random.Random(seed)
+    parts_dir=os.path.join(base_dir,'parts')
+    templates_dir=os.path.join(base_dir,'templates')
+    all_parts=[]
+    for i in xrange(parts):
+        s=SECTIONS[i%len(SECTIONS)]
+        s_dir=os.path.join(parts_dir,s)
+        if not os.path.isdir(s_dir):
+            os.makedirs(s_dir)
+        name='part{0:06d}'.format(i)
+        p_vars=['VAR{0:04d}'.format(rnd.randrange(var_pool)) for v in xrange(vars_per_part)]
+        lines=[]
+        size=0
+        n=0
+        while size<part_size:
+            if p_vars:
+                l='echo line{0} @@{1}@@ {2}\n'.format(n,p_vars[n%len(p_vars)],'x'*40)
+            else:
+                l='echo line{0} {1}\n'.format(n,'x'*40)
+            lines.append(l)
+            size+=len(l)
+            n+=1
+        f=open(os.path.join(s_dir,name),'w')
+        f.write(''.join(lines))
+        f.close()
+        all_parts.append((s,name))
+    for s in SECTIONS:
+        s_dir=os.path.join(parts_dir,s)
+        if not os.path.isdir(s_dir):
+            os.makedirs(s_dir)
+
+    n_links=0
+    for i in xrange(templates):
+        t_dir=os.path.join(templates_dir,'template{0:05d}'.format(i))
+        for s in SECTIONS:
+            os.makedirs(os.path.join(t_dir,s))
+        f=open(os.path.join(t_dir,'README'),'w')
+        f.write('Synthetic template {0}\n'.format(i))
+        f.close()
+        for s,name in rnd.sample(all_parts,min(links,len(all_parts))):
+            os.symlink(os.path.join('..','..','..','parts',s,name),os.path.join(t_dir,s,name))
+            n_links+=1
+    return n_links
+
+def _peak_rss():
+    """Peak resident set size of this process in KiB, see run()"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class _Counter(object):
+    """Write sink that only counts bytes"""
+    def __init__(self):
+        self.size=0
+    def write(self,data):
+        self.size+=len(data)
+
+class _Quiet(object):
+    """Redirect stdout to /dev/null for the duration of with block"""
+    def __enter__(self):
+        self._stdout=sys.stdout
+        sys.stdout=open(os.devnull,'w')
+    def __exit__(self,*exc):
+        sys.stdout.close()
+        sys.stdout=self._stdout
+
+def run(base_dir,repeat=3,assemble_count=20,use_index=False,phases=PHASES):
+    """Time phases, keeping the best of `repeat` runs. Every phase runs
+    in its own forked process, so its peak RSS is not hidden by phases
+    run before. Returns {phase: {'seconds':..,'items':..,'unit':..,
+    'peak_rss_kb':..}}"""
+    ignore_dirs=['RCS']
+    results={}
+
+    def best(phase,func,unit):
+        if not phase in phases:
+            return
+        sys.stdout.flush()
+        sys.stderr.flush()
+        r_fd,w_fd=os.pipe()
+        pid=os.fork()
+        if pid==0:
+            os.close(r_fd)
+            status=1
+            try:
+                times=[]
+                items=0
+                for r in xrange(repeat):
+                    items,elapsed=func()
+                    times.append(elapsed)
+                f=os.fdopen(w_fd,'w')
+                json.dump({'seconds':min(times),'items':items,'unit':unit,
+                           'peak_rss_kb':_peak_rss()},f)
+                f.close()
+                status=0
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        os.close(w_fd)
+        f=os.fdopen(r_fd,'r')
+        data=f.read()
+        f.close()
+        pid,status=os.waitpid(pid,0)
+        if status!=0:
+            raise RuntimeError("Phase {0} failed".format(phase))
+        results[phase]=json.loads(data)
+
+    def conveyor():
+        t=time.time()
+        KSAssembler(base_dir,ignore_dirs,use_index=use_index)
+        return 1,time.time()-t
+
+    def parts_load():
+        a=KSAssembler(base_dir,ignore_dirs,use_index=use_index)
+        t=time.time()
+        a._conveyor.parts.load()
+        elapsed=time.time()-t
+        return sum([len(a._conveyor.parts[s]) for s in SECTIONS]),elapsed
+
+    def templates_load():
+        a=KSAssembler(base_dir,ignore_dirs,use_index=use_index)
+        t=time.time()
+        a._conveyor.templates.load()
+        elapsed=time.time()-t
+        n=0
+        for template in a._conveyor.templates.db.values():
+            for s in template.parts.keys():
+                n+=len(template.parts[s])
+        return n,elapsed
+
+    def lstemplates():
+        a=KSAssembler(base_dir,ignore_dirs,use_index=use_index)
+        t=time.time()
+        with _Quiet():
+            a.lstemplates(list_parts=True,list_vars=True,list_all_parts=True)
+        elapsed=time.time()-t
+        return len(a._conveyor.templates.db),elapsed
+
+    def assemble():
+        a=KSAssembler(base_dir,ignore_dirs,use_index=use_index)
+        a.setTranslate(True)
+        t_ids=sorted(os.listdir(os.path.join(base_dir,'templates')))[:assemble_count]
+        out=_Counter()
+        t=time.time()
+        for tid in t_ids:
+            a.assemble(tid,'--nobase',out=out)
+        elapsed=time.time()-t
+        return out.size,elapsed
+
+    best('conveyor',conveyor,'instances')
+    best('parts_load',parts_load,'parts')
+    best('templates_load',templates_load,'links')
+    best('lstemplates',lstemplates,'templates')
+    best('assemble',assemble,'bytes')
+    return results
+
+def report(results,baseline=None,out=None):
+    print("{0:<16}{1:>12}{2:>24}{3:>14}{4:>10}".format('phase','seconds','throughput','peak RSS KiB','vs base'),file=out)
+    for phase in PHASES:
+        if not results.has_key(phase):
+            continue
+        r=results[phase]
+        if r['seconds']>0:
+            rate="{0:.0f} {1}/s".format(r['items']/r['seconds'],r['unit'])
+        else:
+            rate="-"
+        if baseline and baseline.has_key(phase) and baseline[phase]['seconds']>0:
+            ratio="{0:.2f}x".format(r['seconds']/baseline[phase]['seconds'])
+        else:
+            ratio=""
+        print("{0:<16}{1:>12.4f}{2:>24}{3:>14}{4:>10}".format(phase,r['seconds'],rate,r['peak_rss_kb'],ratio),file=out)
+
+def regressions(results,baseline,tolerance):
+    """Phases slower (or with peak RSS higher) than baseline by more
+    than tolerance (0.2 == 20%)"""
+    slow=[]
+    for phase in PHASES:
+        if not baseline.has_key(phase) or not results.has_key(phase):
+            continue
+        if results[phase]['seconds']>baseline[phase]['seconds']*(1+tolerance):
+            slow.append(phase)
+        if baseline[phase].get('peak_rss_kb') and \
+                results[phase]['peak_rss_kb']>baseline[phase]['peak_rss_kb']*(1+tolerance):
+            slow.append(phase+'(memory)')
+    return slow
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='Benchmark ksconveyor on a synthetic belt')
+    parser.add_argument('--parts',type=int,help='Number of parts',default=1000)
+    parser.add_argument('--templates',type=int,help='Number of templates',default=100)
+    parser.add_argument('--links',type=int,help='Parts linked from every template',default=20)
+    parser.add_argument('--vars',type=int,help='Meta-vars per part',default=5)
+    parser.add_argument('--part-size',type=int,help='Part size in bytes',default=1024)
+    parser.add_argument('--seed',type=int,help='Random seed for belt generation',default=0)
+    parser.add_argument('--repeat',type=int,help='Runs per phase, best one is reported',default=3)
+    parser.add_argument('--assemble-count',type=int,help='Templates to assemble',default=20)
+    parser.add_argument('--phases',type=str,help='Comma separated phases to run (default: all of {0})'.format(','.join(PHASES)),default=','.join(PHASES))
+    parser.add_argument('--index',action='store_const', const=True,default=False,help='Use part metadata index ('+ksconveyor.INDEX_FILE+')')
+    parser.add_argument('--belt-dir',type=str,help='Generate belt here and keep it (reused if it exists)',default=None)
+    parser.add_argument('--save',type=str,help='Save results as JSON baseline',default=None)
+    parser.add_argument('--compare',type=str,help='Compare against JSON baseline',default=None)
+    parser.add_argument('--tolerance',type=float,help='Allowed slowdown against baseline before failing (0.2 == 20%%)',default=0.2)
+    args=parser.parse_args(sys.argv[1:])
+
+    params={'parts':args.parts,'templates':args.templates,'links':args.links,
+            'vars':args.vars,'part_size':args.part_size,'seed':args.seed,
+            'index':args.index}
+    if args.belt_dir:
+        base_dir=args.belt_dir
+        if not os.path.isdir(os.path.join(base_dir,'parts')):
+            make_belt(base_dir,args.parts,args.templates,args.links,args.vars,args.part_size,seed=args.seed)
+    else:
+        base_dir=tempfile.mkdtemp(prefix='ksbench-')
+        make_belt(base_dir,args.parts,args.templates,args.links,args.vars,args.part_size,seed=args.seed)
+    try:
+        results=run(base_dir,args.repeat,args.assemble_count,args.index,args.phases.split(','))
+    finally:
+        if not args.belt_dir:
+            shutil.rmtree(base_dir)
+
+    baseline=None
+    if args.compare:
+        f=open(args.compare,'r')
+        saved=json.load(f)
+        f.close()
+        if saved['params']!=params:
+            print("Warning: baseline was taken with different parameters: {0}".format(saved['params']),file=sys.stderr)
+        baseline=saved['results']
+    report(results,baseline)
+    if args.save:
+        f=open(args.save,'w')
+        json.dump({'params':params,'results':results},f,indent=2,sort_keys=True)
+        f.close()
+    if baseline:
+        slow=regressions(results,baseline,args.tolerance)
+        if slow:
+            print("Regressions: {0}".format(" ".join(slow)),file=sys.stderr)
+            sys.exit(1)
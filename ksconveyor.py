@@ -42,24 +42,342 @@ import argparse
 import os
 import os.path
 import re
+import csv
+import json
+import time
+import cProfile
+import gzip
+import hashlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
 import ConfigParser
+import zipfile
+import mmap
+import errno
+import signal
+import stat
+import socket
+import traceback
+import tempfile
+from collections import OrderedDict
+from cStringIO import StringIO
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir=None
 
 
 SECTIONS=('commands','packages','pre','post','post.header')
 
-class KSPart(object):
-    _name=None
+# part metadata index, kept in BASE_DIR
+INDEX_FILE='.ksconveyor-index'
+
+# assembled kickstarts cache, kept in BASE_DIR
+CACHE_DIR='.ksconveyor-cache'
+
+# output is written in chunks of at least this size
+SINK_BUFSIZE=64*1024
+
+# meta-var defaults, in base dir and template dirs
+VARS_FILE='VARS'
+
+# commands daemon runs for clients, see KSDaemon
+DAEMON_COMMANDS=('assemble','lsparts','lstemplates','info')
+# daemon socket used when --socket is not given
+SOCKET_ENV='KSCONVEYOR_SOCKET'
+
+# meta-variable reference in parts: @@VAR@@
+VAR_RE=re.compile(r'@@(\w+)@@')
+# what may still become a reference when more text follows
+VAR_PREFIX_RE=re.compile(r'@@\w*@?\Z|@\Z')
+
+# MiB of translated parts kept in memory by default, see
+# KSAssembler.setPartCache()
+PART_CACHE_MB=64
+
+# parts bigger than this are never held in memory whole, they are
+# scanned and assembled in STREAM_CHUNK pieces
+STREAM_THRESHOLD=1024*1024
+STREAM_CHUNK=256*1024
+
+class KSStats(object):
+    """Wall time per phase and I/O counters of a run. Phases are
+    non-overlapping: walk (listing dirs, reading links), realpath
+    (resolving template links against parts DB), read (reading part
+    files, wall time of --io-workers prefetch including its scanning),
+    scan (tokenizing and hashing read content), translate (substituting
+    vars) and output (writing assembled KS). Safe to update from
+    several threads"""
+    PHASES=('walk','realpath','read','scan','translate','output')
+    COUNTERS=('files_opened','bytes_read','scanvars_calls','substitutions','part_cache_hits','bytes_written')
+    phases=None
+    counters=None
+    _start=None
+    _lock=None
+    # per thread state, see ignorePhases()
+    _local=None
+
+    def __init__(self):
+        self.phases=OrderedDict([(p,0.0) for p in self.PHASES])
+        self.counters=OrderedDict([(c,0) for c in self.COUNTERS])
+        self._start=time.time()
+        self._lock=threading.Lock()
+        self._local=threading.local()
+
+    def count(self,counter,n=1):
+        with self._lock:
+            self.counters[counter]=self.counters.get(counter,0)+n
+
+    def add(self,phase,seconds):
+        if getattr(self._local,'ignore_phases',False):
+            return
+        with self._lock:
+            self.phases[phase]=self.phases.get(phase,0.0)+seconds
+
+    def ignorePhases(self):
+        """Drop phase times of calling thread (counters still count), for
+        worker threads whose work the caller times as a whole"""
+        self._local.ignore_phases=True
+
+    def asDict(self):
+        return {'total':time.time()-self._start,
+                'phases':self.phases,
+                'counters':self.counters}
+
+    def report(self,out=None):
+        data=self.asDict()
+        print("## stats: total {0:.4f}s".format(data['total']),file=out)
+        for p in self.phases.keys():
+            print("##   {0:<12}{1:>12.4f}s".format(p,self.phases[p]),file=out)
+        for c in self.counters.keys():
+            print("##   {0:<16}{1:>12}".format(c,self.counters[c]),file=out)
+
+    def dump(self,path):
+        f=open(path,'w')
+        json.dump(self.asDict(),f,indent=2)
+        f.close()
+
+# KSStats collecting for this process, None when disabled
+_stats=None
+
+def set_stats(stats):
+    """Start collecting into stats (KSStats), None stops collecting"""
+    global _stats
+    _stats=stats
+
+def get_stats():
+    return _stats
+
+def tokenize(text):
+    """Split text into literal and variable segments: even items are
+    literal text, odd items are variable names"""
+    return VAR_RE.split(text)
+
+def render(tokens,lookup):
+    """Join tokenized text substituting variables. lookup is called once
+    per distinct variable, None leaves the reference untouched"""
+    if _stats is not None:
+        t=time.time()
+    res=list(tokens)
+    subs={}
+    n=0
+    for i in xrange(1,len(res),2):
+        v=res[i]
+        if not subs.has_key(v):
+            subs[v]=lookup(v)
+        if subs[v] is None:
+            res[i]='@@'+v+'@@'
+        else:
+            res[i]=subs[v]
+            n+=1
+    text=''.join(res)
+    if _stats is not None:
+        _stats.add('translate',time.time()-t)
+        _stats.count('substitutions',n)
+    return text
+
+def read_chunks(f,size=STREAM_CHUNK):
+    """Read file object in pieces of size"""
+    while True:
+        if _stats is not None:
+            t=time.time()
+        chunk=f.read(size)
+        if _stats is not None:
+            _stats.add('read',time.time()-t)
+            _stats.count('bytes_read',len(chunk))
+        if not chunk:
+            break
+        yield chunk
+
+def stream_tokens(chunks):
+    """tokenize() for a sequence of text chunks, yields token list per
+    chunk. Tail of a chunk which may be the start of a reference is held
+    back and prepended to the next chunk, so references crossing chunk
+    boundaries are found. Held back text is no longer than the @@ and
+    word characters following it"""
+    pending=''
+    for chunk in chunks:
+        tokens=VAR_RE.split(pending+chunk)
+        m=VAR_PREFIX_RE.search(tokens[-1])
+        if m is None:
+            pending=''
+        else:
+            pending=tokens[-1][m.start():]
+            tokens[-1]=tokens[-1][:m.start()]
+        yield tokens
+    if pending:
+        yield [pending]
+
+def substitute(text,lookup):
+    """Single pass substitution over arbitrary text"""
+    def _sub(m):
+        s=lookup(m.group(1))
+        if s is None:
+            return m.group(0)
+        return s
+    return VAR_RE.sub(_sub,text)
+
+def parse_vars(text):
+    """Parse KEY=value lines (blank lines and # comments skipped, value
+    may be quoted) into OrderedDict"""
+    my_vars=OrderedDict()
+    for l in text.splitlines():
+        l=l.strip()
+        if not l or l.startswith('#') or not '=' in l:
+            continue
+        k,v=l.split('=',1)
+        v=v.strip()
+        if len(v)>=2 and v[0]==v[-1] and v[0] in '"\'':
+            v=v[1:-1]
+        my_vars[k.strip()]=v
+    return my_vars
+
+def format_vars(my_vars):
+    """Inverse of parse_vars()"""
+    return ''.join(['{0}="{1}"\n'.format(k,v) for k,v in my_vars.items()])
+
+class KSVarsFile(object):
+    """Vars file (see parse_vars()), re-read only when its mtime
+    changes. Missing file holds no vars"""
     _path=None
-    _translate_extractor=None
-    _translate=None
+    _mtime=None
     _vars=None
 
+    def __init__(self,path):
+        self._path=path
+        self._vars=OrderedDict()
+
+    def get(self):
+        try:
+            mtime=os.stat(self._path).st_mtime
+        except OSError:
+            self._mtime=None
+            self._vars=OrderedDict()
+            return self._vars
+        if mtime!=self._mtime:
+            f=open(self._path,'r')
+            self._vars=parse_vars(f.read())
+            f.close()
+            self._mtime=mtime
+        return self._vars
+
+class KSVars(object):
+    """Read-only meta-var values from layered sources. Layers are
+    (origin,mapping) pairs from lowest to highest precedence, a KSVars
+    layer brings origins of its own. Every var is resolved on first
+    lookup only, so an assembly costs a lookup per distinct var used
+    by its parts"""
+    __slots__=('_layers','_resolved')
+
+    def __init__(self,layers=()):
+        self._layers=[(o,m) for o,m in layers if m]
+        self._layers.reverse()
+        # var -> (value,origin), (None,None) for unknown ones
+        self._resolved={}
+
+    def _resolve(self,var):
+        r=self._resolved.get(var)
+        if r is None:
+            r=(None,None)
+            for origin,mapping in self._layers:
+                if var in mapping:
+                    if isinstance(mapping,KSVars):
+                        r=mapping._resolve(var)
+                    else:
+                        r=(mapping[var],origin)
+                    break
+            self._resolved[var]=r
+        return r
+
+    def get(self,var,default=None):
+        value=self._resolve(var)[0]
+        if value is None:
+            return default
+        return value
+
+    def origin(self,var):
+        """Name of the layer var's value comes from, None if unknown"""
+        return self._resolve(var)[1]
+
+    def __getitem__(self,var):
+        value=self._resolve(var)[0]
+        if value is None:
+            raise KeyError(var)
+        return value
+
+    def __contains__(self,var):
+        return self._resolve(var)[0] is not None
+
+    def has_key(self,var):
+        return var in self
+
+    def keys(self):
+        my_keys=set()
+        for origin,mapping in self._layers:
+            my_keys.update(mapping.keys())
+        return list(my_keys)
+
+class KSPart(object):
+    # there may be 100k+ parts and links loaded, keep instances compact
+    __slots__=(
+        '_name',
+        '_path',
+        '_translate',
+        # set of variables, allocated once content is scanned
+        '_vars',
+        # cached file content and the mtime it was read at
+        '_content',
+        '_mtime',
+        # content split by tokenize()
+        '_tokens',
+        # content hash, _vars and _digest are valid for _meta_mtime
+        '_digest',
+        '_meta_mtime',
+        # KSPartIndex to consult before reading the file
+        '_index',
+    )
+    # Parts over STREAM_THRESHOLD keep just _vars and _digest, content
+    # is streamed from the file by _chunks() whenever needed
+
     def __init__(self,path):
         self._name=os.path.basename(path)
         self._path=path
-        self._translate_extractor=re.compile(r'@@(\w+)@@')
         self._translate=False
-        self._vars=set()
+        self._vars=None
+        self._content=None
+        self._mtime=None
+        self._tokens=None
+        self._digest=None
+        self._meta_mtime=None
+        self._index=None
 
     def setTranslate(self,translate):
         self._translate=translate
@@ -85,54 +403,192 @@ class KSPart(object):
     name=property(getName,setName)
 
     def _translator(self,my_text):
-        sub_vars=self.listVars(my_text)
-        for sv in sub_vars:
-            self._vars.add(sv)
-        # print(sub_vars)
-        res_text=my_text
-        for my_var in sub_vars:
-            my_sub=self._var_lookup(my_var)
-            if not my_sub is None:
-                res_text=re.sub('@@'+my_var+'@@',my_sub,res_text)
-        return res_text
-
-    def lines(self):
-        f=open(self._path,'r')
-        for l in f:
-            if self._translate:
-                yield self._translator(l)
+        return substitute(my_text,self._var_lookup)
+
+    def setIndex(self,index):
+        self._index=index
+
+    def getSourcePath(self):
+        """Path of the file holding part's content"""
+        return self._path
+
+    def _read(self,st=None):
+        """Return part content, file is re-read only if its mtime changed.
+        Parts too big to be kept in memory return None"""
+        if st is None:
+            st=os.stat(self._path)
+        if st.st_size>STREAM_THRESHOLD:
+            self._content=None
+            self._tokens=None
+            self._mtime=None
+            if st.st_mtime!=self._meta_mtime:
+                self._scanStream(st)
+            return None
+        if self._content is None or st.st_mtime!=self._mtime:
+            if _stats is not None:
+                t=time.time()
+            f=open(self._path,'r')
+            content=f.read()
+            f.close()
+            if _stats is not None:
+                t_read=time.time()
+                _stats.add('read',t_read-t)
+                _stats.count('files_opened')
+                _stats.count('bytes_read',len(content))
+            # content and _mtime go last, threads checking them (see
+            # KSServer) never see new content with old tokens
+            self._tokens=tokenize(content)
+            self._vars=set(self._tokens[1::2])
+            self._digest=hashlib.sha1(content).hexdigest()
+            self._meta_mtime=st.st_mtime
+            self._content=content
+            self._mtime=st.st_mtime
+            if _stats is not None:
+                _stats.add('scan',time.time()-t_read)
+            if self._index is not None:
+                self._index.update(self.getSourcePath(),st,self._digest,self._vars)
+        return self._content
+
+    def _scanStream(self,st):
+        """Find variables and hash of a big part reading it in chunks"""
+        if _stats is not None:
+            t=time.time()
+            _stats.count('files_opened')
+        digest=hashlib.sha1()
+        my_vars=set()
+        def _hashed(chunks):
+            for chunk in chunks:
+                digest.update(chunk)
+                yield chunk
+        f=open(self._path,'rb')
+        try:
+            for tokens in stream_tokens(_hashed(read_chunks(f))):
+                my_vars.update(tokens[1::2])
+        finally:
+            f.close()
+        self._vars=my_vars
+        self._digest=digest.hexdigest()
+        self._meta_mtime=st.st_mtime
+        if _stats is not None:
+            _stats.add('scan',time.time()-t)
+        if self._index is not None:
+            self._index.update(self.getSourcePath(),st,self._digest,self._vars)
+
+    def _scanMeta(self):
+        """Make sure _vars and _digest match the file. Costs a single stat
+        when the index already knows the file, reads it otherwise"""
+        st=os.stat(self._path)
+        if st.st_mtime==self._meta_mtime:
+            return
+        if self._index is not None:
+            entry=self._index.lookup(self.getSourcePath(),st)
+            if entry is not None:
+                self._vars=set([str(v) for v in entry['vars']])
+                self._digest=str(entry['sha1'])
+                self._meta_mtime=st.st_mtime
+                return
+        self._read(st)
+
+    def prefetch(self):
+        """Make sure content is read, called from I/O threads"""
+        self._read()
+
+    def invalidate(self):
+        """Drop cached content, next access goes to disk"""
+        self._content=None
+        self._mtime=None
+        self._tokens=None
+        self._meta_mtime=None
+
+    def getDigest(self):
+        """SHA1 of part content"""
+        self._scanMeta()
+        return self._digest
+
+    def getSource(self):
+        """Part holding the content, links return the shared original"""
+        return self
+
+    def cacheKey(self,variables=None):
+        """Identity of translated content: source path, content hash and
+        values of just the variables the part uses"""
+        self._scanMeta()
+        lookup=self._lookup(variables)
+        return (self.getSourcePath(),self._digest,
+                tuple([(v,lookup(v)) for v in sorted(self._vars)]))
+
+    def text(self,variables=None):
+        """Whole part content, translated if requested. Variables are
+        taken from the variables mapping or from environment"""
+        return self._text(self._translate,variables)
+
+    def _text(self,translate,variables):
+        content=self._read()
+        if content is None:
+            return ''.join(self._chunks(translate,variables))
+        if translate:
+            return render(self._tokens,self._lookup(variables))
+        return content
+
+    def chunks(self,variables=None):
+        """Like text() in pieces, big parts are streamed from disk with
+        bounded memory use"""
+        return self._chunks(self._translate,variables)
+
+    def _chunks(self,translate,variables):
+        content=self._read()
+        if content is not None:
+            if translate:
+                yield render(self._tokens,self._lookup(variables))
             else:
-                yield l
-        f.close()
+                yield content
+            return
+        if _stats is not None:
+            _stats.count('files_opened')
+        f=open(self._path,'rb')
+        try:
+            if translate:
+                lookup=self._lookup(variables)
+                for tokens in stream_tokens(read_chunks(f)):
+                    yield render(tokens,lookup)
+            else:
+                for chunk in read_chunks(f):
+                    yield chunk
+        finally:
+            f.close()
+
+    def lines(self,variables=None):
+        for l in StringIO(self.text(variables)):
+            yield l
 
     def getVars(self):
+        if self._vars is None:
+            return []
         my_vars=list(self._vars)
         my_vars.sort()
         return my_vars
 
-    def varSubs(self):
-        if self._vars:
-            my_vars=self._vars
-        else:
-            my_vars=self.scanVars()
+    def varSubs(self,variables=None):
+        my_vars=self.scanVars()
 
+        lookup=self._lookup(variables)
         subs={}
         for v in my_vars:
-            lv=self._var_lookup(v)
+            lv=lookup(v)
             if lv:
                 subs[v]=lv
         return subs
         
     def listVars(self,my_text):
-        my_vars=self._translate_extractor.findall(my_text)
+        my_vars=VAR_RE.findall(my_text)
         my_vars.sort()
         return my_vars
 
     def scanVars(self):
-        for l in self.lines():
-            pre_vars=self._translate_extractor.findall(l)
-            for v in pre_vars:
-                self._vars.add(v)
+        # variables get extracted whenever content is (re)read
+        if _stats is not None:
+            _stats.count('scanvars_calls')
+        self._scanMeta()
         my_vars=list(self._vars)
         my_vars.sort()
         return my_vars
@@ -144,14 +600,55 @@ class KSPart(object):
         else:
             return None
 
+    def _lookup(self,variables):
+        if variables is None:
+            return self._var_lookup
+        return variables.get
+
 class KSPartL(KSPart):
     """Link to the original part. Behaves like a normal KSPart, only
-    stores link to the original and can "materialize" """
-    _orig_path=None
-    def __init__(self,path,orig_path):
+    stores link to the original and can "materialize". Content and
+    metadata come from the source part, which is shared by all links
+    to the same file when it is interned in KSPartsDB"""
+    __slots__=('_orig_path','_source')
+
+    def __init__(self,path,orig_path,source=None):
         super(KSPartL,self).__init__(path)
         # self._orig_path=os.readlink(path)
         self._orig_path=orig_path
+        if source is None:
+            source=KSPart(orig_path)
+        self._source=source
+
+    def getSource(self):
+        return self._source
+
+    def setSource(self,source):
+        self._source=source
+
+    def setIndex(self,index):
+        self._source.setIndex(index)
+
+    def invalidate(self):
+        self._source.invalidate()
+
+    def getDigest(self):
+        return self._source.getDigest()
+
+    def text(self,variables=None):
+        return self._source._text(self._translate,variables)
+
+    def chunks(self,variables=None):
+        return self._source._chunks(self._translate,variables)
+
+    def getVars(self):
+        return self._source.getVars()
+
+    def scanVars(self):
+        return self._source.scanVars()
+
+    def cacheKey(self,variables=None):
+        return self._source.cacheKey(variables)
 
     def materialize(self):
         my_dir=os.path.dirname(self._path)
@@ -161,6 +658,9 @@ class KSPartL(KSPart):
     def getOrigPath(self):
         return self._orig_path
 
+    def getSourcePath(self):
+        return self._orig_path
+
     def setOrigPath(self,new_orig_path):
         # we're changing origin here...
         # 1. remove existing link
@@ -171,16 +671,20 @@ class KSPartL(KSPart):
         os.symlink(os.path.relpath(new_orig_path,my_dir),self._path)
         # src_part=os.path.join(os.path.relpath(parts_dir,os.path.join(template_dir,p)),p,pe)
         self._orig_path=new_orig_path
+        # private source until somebody hands over the shared one
+        self._source=KSPart(new_orig_path)
 
     orig_path=property(getOrigPath,setOrigPath)
 
 class KSPartV(KSPartL):
     """Virtual part, needed for ad-hoc parts addition. Somewhat evil hacked"""
-    def __init__(self,path,orig_path):
+    __slots__=()
+
+    def __init__(self,path,orig_path,source=None):
         """call ancestor and ignore non-essential stuff"""
         # We'll ignore path relative to template... just store
         # origin's path
-        super(KSPartV,self).__init__(orig_path,orig_path)
+        super(KSPartV,self).__init__(orig_path,orig_path,source)
 
     def materialize(self):
         """Materialize the link... not really important for this subclass"""
@@ -191,38 +695,187 @@ class KSPartV(KSPartL):
         """Change the path to the origin. Should not really need it, but "just in case" """
         self._orig_path=new_orig_path
 
+class KSPartIndex(object):
+    """Persistent part metadata: mtime, size, content hash and variables,
+    keyed by part's source path relative to index location. Entries are
+    trusted only while mtime and size match the file"""
+    _path=None
+    _base=None
+    _db=None
+    _dirty=None
+
+    def __init__(self,path):
+        self._path=path
+        self._base=os.path.dirname(os.path.abspath(path))
+        self._db={}
+        self._dirty=False
+
+    def load(self):
+        try:
+            f=open(self._path,'r')
+        except IOError:
+            return
+        try:
+            self._db=json.load(f)
+        except ValueError:
+            # corrupted index, start over
+            self._db={}
+        f.close()
+
+    def save(self):
+        """Write index back if anything changed. Failures are ignored,
+        belt may well be read-only"""
+        if not self._dirty:
+            return
+        try:
+            replace_file(self._path,json.dumps(self._db))
+        except (IOError,OSError):
+            return
+        self._dirty=False
+
+    def _key(self,path):
+        return os.path.relpath(os.path.abspath(path),self._base)
+
+    def lookup(self,path,st):
+        entry=self._db.get(self._key(path))
+        if entry is None:
+            return None
+        if entry['mtime']!=st.st_mtime or entry['size']!=st.st_size:
+            return None
+        return entry
+
+    def update(self,path,st,digest,variables):
+        my_vars=list(variables)
+        my_vars.sort()
+        self._db[self._key(path)]={'mtime':st.st_mtime,
+                                   'size':st.st_size,
+                                   'sha1':digest,
+                                   'vars':my_vars}
+        self._dirty=True
+
+def read_links(path):
+    """List directory in a single pass, returns sorted (name, link target)
+    pairs, target is None for entries which are not symlinks. With scandir
+    the entry type comes from the directory listing itself, so only links
+    cost an extra readlink() and nothing is stat()-ed"""
+    entries=[]
+    if scandir is not None:
+        for e in scandir(path):
+            if e.is_symlink():
+                entries.append((e.name,os.readlink(e.path)))
+            else:
+                entries.append((e.name,None))
+    else:
+        for name in os.listdir(path):
+            try:
+                target=os.readlink(os.path.join(path,name))
+            except OSError:
+                target=None
+            entries.append((name,target))
+    entries.sort()
+    return entries
+
 class KSPartsDB(object):
     _db=None
     _path=None
     _blacklist=None
     _translate=None
-
-    def __init__(self,path,blacklist=[],translate=False):
+    # sections already listed from disk
+    _loaded=None
+    _index=None
+    # interned parts: real path -> KSPart, see intern()
+    _by_path=None
+    # section -> absolute path of section dir
+    _section_paths=None
+
+    def __init__(self,path,blacklist=[],translate=False,index=None):
         self._db={}
+        self._loaded=set()
         self._path=path
         self._blacklist=blacklist
         self._translate=translate
+        self._index=index
+        self._by_path={}
+        self._section_paths={}
 
     def load(self):
         for s in SECTIONS:
-            s_path=os.path.join(self._path,s)
-            if not self._db.has_key(s):
-                self._db[s]={}
-            pn_list=os.listdir(s_path)
-            pn_list.sort()
-            for pn in pn_list:
-                if not pn in self._blacklist:
+            self._loadSection(s)
+
+    def _loadSection(self,s):
+        s_path=os.path.join(self._path,s)
+        if not self._db.has_key(s):
+            self._db[s]={}
+        if _stats is not None:
+            t=time.time()
+        pn_list=os.listdir(s_path)
+        if _stats is not None:
+            _stats.add('walk',time.time()-t)
+        pn_list.sort()
+        abs_s_path=self.sectionPath(s)
+        for pn in pn_list:
+            if not pn in self._blacklist and not self._db[s].has_key(pn):
+                real_path=os.path.join(abs_s_path,pn)
+                new_part=self._by_path.get(real_path)
+                if new_part is None:
                     new_part=KSPart(os.path.join(s_path,pn))
                     new_part.setTranslate(self._translate)
-                    self._db[s][pn]=new_part
+                    new_part.setIndex(self._index)
+                    self._by_path[real_path]=new_part
+                self._db[s][pn]=new_part
+        self._loaded.add(s)
+
+    def sectionPath(self,s):
+        """Absolute, normalized path of section dir. Template links are
+        resolved lexically against it, see KSTemplate.load()"""
+        if not self._section_paths.has_key(s):
+            self._section_paths[s]=os.path.abspath(os.path.join(self._path,s))
+        return self._section_paths[s]
+
+    def intern(self,real_path):
+        """Shared part for the file at real_path (absolute, normalized),
+        all template links to the same file get the same object so the
+        file is read and scanned once"""
+        part=self._by_path.get(real_path)
+        if part is None:
+            part=KSPart(real_path)
+            part.setTranslate(self._translate)
+            part.setIndex(self._index)
+            self._by_path[real_path]=part
+        return part
+
+    def rename(self,section,src_name,dst_name):
+        """Rename part's file, returns the part"""
+        part=self[section][src_name]
+        abs_s_path=self.sectionPath(section)
+        part.name=dst_name
+        self._db[section][dst_name]=self._db[section].pop(src_name)
+        self._by_path.pop(os.path.join(abs_s_path,src_name),None)
+        self._by_path[os.path.join(abs_s_path,dst_name)]=part
+        return part
+
+    def rescanPart(self,real_path):
+        """Sync listed sections with the file at real_path (absolute,
+        normalized) having appeared or gone away since listing"""
+        p_dir,name=os.path.split(real_path)
+        exists=os.path.isfile(real_path)
+        if not exists:
+            self._by_path.pop(real_path,None)
+        for s in self._loaded:
+            if self.sectionPath(s)!=p_dir:
+                continue
+            if not exists:
+                self._db[s].pop(name,None)
+            elif not name in self._blacklist:
+                self._db[s][name]=self.intern(real_path)
 
     def setTranslate(self,translate):
         self._translate=translate
 
     def setTranslateAll(self,translate):
-        for s in self._db.keys():
-            for p in self._db[s].keys():
-                self._db[s][p].setTranslate(translate)
+        # every part in _db is interned as well
+        for p in self._by_path.values():
+            p.setTranslate(translate)
         self._translate=translate
 
     def getBlacklist(self):
@@ -234,11 +887,18 @@ class KSPartsDB(object):
     blacklist=property(getBlacklist,setBlacklist)
 
     def getDB(self):
+        """Full parts DB, every section gets listed first"""
+        for s in SECTIONS:
+            if not s in self._loaded:
+                self._loadSection(s)
         return self._db
 
     db=property(getDB)
 
     def __getitem__(self,k):
+        """Section lookup, section gets listed on first access"""
+        if not k in self._loaded and k in SECTIONS:
+            self._loadSection(k)
         return self._db[k]
 
 class KSTemplate(object):
@@ -248,10 +908,19 @@ class KSTemplate(object):
     _name=None
     _path=None
     _info=None
-    def __init__(self,template_id,path):
+    # KSPartsDB to intern linked parts in
+    _parts_db=None
+    # links not pointing into parts DB, see load()
+    _problems=None
+    # template's meta-var defaults
+    _vars_file=None
+    def __init__(self,template_id,path,parts_db=None):
         self._name=template_id
         self._parts={}
+        self._problems=[]
+        self._vars_file=KSVarsFile(os.path.join(path,VARS_FILE))
         self._path=path
+        self._parts_db=parts_db
 
     def load(self):
         info_path=os.path.join(self._path,'README')
@@ -259,14 +928,70 @@ class KSTemplate(object):
             info_file=open(info_path,'r')
             self._info=info_file.read()
             info_file.close()
+            if _stats is not None:
+                _stats.count('files_opened')
+                _stats.count('bytes_read',len(self._info))
+        self._problems=[]
         for s in SECTIONS:
             self._parts[s]={}
             s_path=os.path.join(self._path,s)
-            p_list=os.listdir(s_path)
-            p_list.sort()
-            for p in p_list:
+            abs_s_path=os.path.abspath(s_path)
+            if _stats is not None:
+                t=time.time()
+            p_list=read_links(s_path)
+            if _stats is not None:
+                t_walk=time.time()
+                _stats.add('walk',t_walk-t)
+            if self._parts_db is not None:
+                parts_s_path=self._parts_db.sectionPath(s)
+                blacklist=self._parts_db.blacklist
+            else:
+                blacklist=()
+            for p,target in p_list:
+                if p in blacklist:
+                    continue
                 p_path=os.path.join(s_path,p)
-                self._parts[s][p]=KSPartL(p_path,os.path.realpath(p_path))
+                if target is None:
+                    real_path=os.path.join(abs_s_path,p)
+                else:
+                    # resolve lexically, same as parts DB keys
+                    real_path=os.path.normpath(os.path.join(abs_s_path,target))
+                if self._parts_db is not None:
+                    p_dir,p_name=os.path.split(real_path)
+                    if p_dir!=parts_s_path:
+                        if not os.path.isfile(real_path):
+                            self._problem(s,p,'broken',real_path)
+                            continue
+                        self._problem(s,p,'foreign',real_path)
+                    elif not self._parts_db[s].has_key(p_name):
+                        # dangling link, nothing to assemble from
+                        self._problem(s,p,'broken',real_path)
+                        continue
+                    source=self._parts_db.intern(real_path)
+                else:
+                    source=None
+                self._parts[s][p]=KSPartL(p_path,real_path,source)
+            if _stats is not None:
+                _stats.add('realpath',time.time()-t_walk)
+
+    def _problem(self,section,name,kind,real_path):
+        """Record and report link which does not point into parts DB,
+        broken links (and entries which are not files) are left out of
+        the template, foreign ones kept"""
+        self._problems.append((section,name,kind,real_path))
+        if kind=='broken':
+            msg="{0} is missing or not a file, skipped"
+        else:
+            msg="links outside of parts/{1}: {0}"
+        print("Warning: template {0}: {1}/{2}: ".format(self._name,section,name)+
+              msg.format(real_path,section),file=sys.stderr)
+
+    def getProblems(self):
+        """(section, name, 'broken'|'foreign', target) for links found by
+        load() not pointing to a part in parts DB"""
+        return self._problems
+
+    problems=property(getProblems)
 
     def init(self):
         template_dir=self._path
@@ -296,7 +1021,7 @@ class KSTemplate(object):
         name=part.name
         section_dir=os.path.join(template_dir,section)
         tpart_path=os.path.join(section_dir,name)
-        p=part_type(tpart_path,part.path)
+        p=part_type(tpart_path,part.path,part.getSource())
         self._parts[section][name]=p
         return p
 
@@ -308,9 +1033,24 @@ class KSTemplate(object):
         p.materialize()
         return p
 
+    def removePart(self,section,part_name):
+        """Detach part and remove its link from template dir"""
+        p=self._parts[section].pop(part_name)
+        os.unlink(p.path)
+        return p
+
     def getParts(self):
         return self._parts
 
+    def getName(self):
+        return self._name
+
+    def getPath(self):
+        return self._path
+
+    name=property(getName)
+    path=property(getPath)
+
     def getInfo(self):
         if self._info is None:
             return ""
@@ -320,66 +1060,463 @@ class KSTemplate(object):
 
     parts=property(getParts)
 
+    def getVarDefaults(self):
+        """Meta-var values from template's VARS file"""
+        return self._vars_file.get()
+
 class KSTemplateDB(object):
     _db=None
     _path=None
-    def __init__(self,path):
+    _translate=None
+    # True once every template on disk has been loaded
+    _loaded=None
+    _index=None
+    # reverse index: (section,part_name) -> set of template IDs
+    _users=None
+    # KSPartsDB sharing part objects with templates
+    _parts_db=None
+    def __init__(self,path,index=None,parts_db=None):
         self._db={}
         self._path=path
+        self._translate=False
+        self._loaded=False
+        self._index=index
+        self._users={}
+        self._parts_db=parts_db
 
     def load(self):
+        """Eager walk over all templates, only needed when enumerating"""
+        if _stats is not None:
+            t=time.time()
         t_list=os.listdir(self._path)
+        if _stats is not None:
+            _stats.add('walk',time.time()-t)
         t_list.sort()
         for t in t_list:
-            kst=KSTemplate(t,os.path.join(self._path,t))
-            kst.load()
-            self._db[t]=kst
+            if not self._db.has_key(t):
+                self._loadTemplate(t)
+        self._loaded=True
+
+    def _loadTemplate(self,template_id):
+        kst=self.newTemplate(template_id)
+        kst.load()
+        for s in kst.parts.keys():
+            for k in kst.parts[s].keys():
+                kst.parts[s][k].setTranslate(self._translate)
+                kst.parts[s][k].setIndex(self._index)
+        self._db[template_id]=kst
+        self._register(kst)
+        return kst
+
+    def _register(self,template):
+        for s in template.parts.keys():
+            for p in template.parts[s].keys():
+                self.noteLink(template.name,s,p)
+
+    def noteLink(self,template_id,section,part_name):
+        """Record that template uses part in reverse index"""
+        if not self._users.has_key((section,part_name)):
+            self._users[(section,part_name)]=set()
+        self._users[(section,part_name)].add(template_id)
+
+    def forgetLink(self,template_id,section,part_name):
+        """Drop template from part's users in reverse index"""
+        users=self._users.get((section,part_name))
+        if users:
+            users.discard(template_id)
+
+    def loadedIDs(self):
+        """IDs of templates loaded so far"""
+        return self._db.keys()
+
+    def forget(self,template_id):
+        """Drop loaded template, next access loads it from disk again"""
+        template=self._db.pop(template_id,None)
+        if template is None:
+            return
+        for s in template.parts.keys():
+            for p in template.parts[s].keys():
+                self.forgetLink(template_id,s,p)
+
+    def reload(self,template_id):
+        self.forget(template_id)
+        return self[template_id]
+
+    def rescan(self):
+        """Sync loaded templates with the templates dir. Returns (added,
+        removed) lists of template IDs"""
+        on_disk=set(os.listdir(self._path))
+        removed=[t for t in self._db.keys() if not t in on_disk]
+        for t in removed:
+            self.forget(t)
+        added=[t for t in on_disk if not self._db.has_key(t)]
+        added.sort()
+        for t in added:
+            self._loadTemplate(t)
+        self._loaded=True
+        removed.sort()
+        return added,removed
+
+    def getPath(self):
+        return self._path
+
+    path=property(getPath)
+
+    def whereUsed(self,section,part_name):
+        """Sorted IDs of templates linking to section's part"""
+        if not self._loaded:
+            self.load()
+        users=list(self._users.get((section,part_name),()))
+        users.sort()
+        return users
 
     def newTemplate(self,template_id):
-        return KSTemplate(template_id,os.path.join(self._path,template_id))
+        return KSTemplate(template_id,os.path.join(self._path,template_id),self._parts_db)
 
     def getDB(self):
+        """Full template DB, loads all templates on first access"""
+        if not self._loaded:
+            self.load()
         return self._db
 
     db=property(getDB)
 
     def __getitem__(self,k):
+        """Template lookup, loads just the requested template from disk"""
+        if not self._db.has_key(k):
+            if os.path.sep in k or k in (os.curdir,os.pardir) or \
+                    not os.path.isdir(os.path.join(self._path,k)):
+                raise KeyError(k)
+            self._loadTemplate(k)
         return self._db[k]
 
+    def __setitem__(self,k,template):
+        self._db[k]=template
+        self._register(template)
+
     def setTranslateAll(self,translate):
         for t in self._db.keys():
             for s in self._db[t].parts.keys():
                 for k in self._db[t].parts[s].keys():
                     self._db[t].parts[s][k].setTranslate(translate)
+        self._translate=translate
+
+def read_only(path):
+    """Error raised by attempts to modify a packed belt"""
+    return IOError(errno.EROFS,"Packed belt is read-only",path)
+
+def _belt_str(obj):
+    """Manifest strings back to (utf-8) byte strings, like names on disk"""
+    if isinstance(obj,dict):
+        return dict([(_manifest_str(k),_belt_str(v)) for k,v in obj.items()])
+    if isinstance(obj,list):
+        return [_belt_str(v) for v in obj]
+    if isinstance(obj,unicode):
+        return obj.encode('utf-8')
+    return obj
+
+class _MapFile(object):
+    """File-like view of mmap for zipfile, mmap.read() needs an
+    explicit size"""
+    def __init__(self,map):
+        self._map=map
+
+    def read(self,n=-1):
+        if n<0:
+            n=self._map.size()-self._map.tell()
+        return self._map.read(n)
+
+    def seek(self,pos,whence=0):
+        self._map.seek(pos,whence)
+
+    def tell(self):
+        return self._map.tell()
+
+class KSBelt(object):
+    """Packed belt: single zip file holding content of every part and
+    template README plus a JSON manifest:
+
+    {"version": 1,
+     "parts": {section: [part_name, ...]},
+     "templates": {template_id: {"info": entry or null,
+                                 "links": {section: {part_name: entry}},
+                                 "vars": {var: value}}},
+     "files": {entry: {"sha1": ..., "vars": [...]}},
+     "vars": {var: value}}
+
+    "vars" are meta-var defaults from VARS files, optional.
+
+    Parts live in parts/<section>/<name> entries, links pointing outside
+    of parts DB get their own templates/<id>/<section>/<name> entry.
+    Entries are stored uncompressed and the file is memory-mapped, so
+    loading costs one open() and reading a part is a copy out of page
+    cache"""
+    MANIFEST='belt.json'
+    VERSION=1
+    _path=None
+    _file=None
+    _map=None
+    _zip=None
+    _manifest=None
+
+    def __init__(self,path):
+        self._path=path
+        self._file=open(path,'rb')
+        self._map=mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+        self._zip=zipfile.ZipFile(_MapFile(self._map))
+        manifest=json.loads(self._zip.read(self.MANIFEST))
+        if manifest.get('version')!=self.VERSION:
+            raise ValueError("Unsupported belt file version: {0}".format(manifest.get('version')))
+        self._manifest=_belt_str(manifest)
+
+    def read(self,entry):
+        data=self._zip.read(entry)
+        if _stats is not None:
+            _stats.count('bytes_read',len(data))
+        return data
+
+    def close(self):
+        self._zip.close()
+        self._map.close()
+        self._file.close()
+
+    def getPath(self):
+        return self._path
+
+    def getManifest(self):
+        return self._manifest
+
+    path=property(getPath)
+    manifest=property(getManifest)
+
+class KSPackedPart(KSPart):
+    """Part stored in a packed belt. Digest and variables come from the
+    manifest, content is read on first use and never changes"""
+    __slots__=('_belt','_entry')
+
+    def __init__(self,path,belt,entry):
+        super(KSPackedPart,self).__init__(path)
+        self._belt=belt
+        self._entry=entry
+        meta=belt.manifest['files'][entry]
+        self._digest=meta['sha1']
+        self._vars=set(meta['vars'])
+
+    def setName(self,name):
+        raise read_only(self._belt.path)
+
+    name=property(KSPart.getName,setName)
+
+    def setIndex(self,index):
+        # manifest already holds the metadata
+        pass
+
+    def _read(self,st=None):
+        if self._content is None:
+            if _stats is not None:
+                t=time.time()
+            content=self._belt.read(self._entry)
+            if _stats is not None:
+                t_read=time.time()
+                _stats.add('read',t_read-t)
+            self._tokens=tokenize(content)
+            self._content=content
+            if _stats is not None:
+                _stats.add('scan',time.time()-t_read)
+        return self._content
+
+    def _scanMeta(self):
+        pass
+
+    def prefetch(self):
+        # zip reads share one file position, and come from memory anyway
+        pass
+
+    def invalidate(self):
+        pass
+
+class KSPackedPartsDB(KSPartsDB):
+    """Read-only parts DB loaded from a packed belt"""
+    _belt=None
+
+    def __init__(self,path,belt,translate=False):
+        super(KSPackedPartsDB,self).__init__(path,[],translate)
+        self._belt=belt
+
+    def _loadSection(self,s):
+        if not self._db.has_key(s):
+            self._db[s]={}
+        for pn in self._belt.manifest['parts'].get(s,[]):
+            if not self._db[s].has_key(pn):
+                self._db[s][pn]=self.internEntry('parts/'+s+'/'+pn)
+        self._loaded.add(s)
+
+    def entryPath(self,entry):
+        """Path the entry would have in an unpacked belt"""
+        if entry.startswith('parts/'):
+            s,pn=entry.split('/')[1:]
+            return os.path.join(self.sectionPath(s),pn)
+        return os.path.abspath(os.path.join(os.path.dirname(self._path),*entry.split('/')))
+
+    def internEntry(self,entry):
+        """Shared part for belt entry"""
+        path=self.entryPath(entry)
+        part=self._by_path.get(path)
+        if part is None:
+            part=KSPackedPart(path,self._belt,entry)
+            part.setTranslate(self._translate)
+            self._by_path[path]=part
+        return part
+
+    def rename(self,section,src_name,dst_name):
+        raise read_only(self._belt.path)
+
+class KSPackedTemplate(KSTemplate):
+    """Template loaded from a packed belt, can't be modified"""
+    _belt=None
+
+    def __init__(self,template_id,path,parts_db,belt):
+        super(KSPackedTemplate,self).__init__(template_id,path,parts_db)
+        self._belt=belt
+
+    def load(self):
+        t_meta=self._belt.manifest['templates'][self._name]
+        if t_meta['info'] is not None:
+            self._info=self._belt.read(t_meta['info'])
+        for s in SECTIONS:
+            self._parts[s]={}
+            s_path=os.path.join(self._path,s)
+            links=t_meta['links'].get(s,{})
+            for p in sorted(links.keys()):
+                source=self._parts_db.internEntry(links[p])
+                self._parts[s][p]=KSPartL(os.path.join(s_path,p),source.path,source)
+
+    def getVarDefaults(self):
+        return self._belt.manifest['templates'][self._name].get('vars',{})
+
+    def init(self):
+        raise read_only(self._belt.path)
+
+    def attachPart(self,section,part,part_type=KSPartL):
+        raise read_only(self._belt.path)
+
+    def removePart(self,section,part_name):
+        raise read_only(self._belt.path)
+
+class KSPackedTemplateDB(KSTemplateDB):
+    """Read-only template DB loaded from a packed belt"""
+    _belt=None
+
+    def __init__(self,path,belt,parts_db):
+        super(KSPackedTemplateDB,self).__init__(path,None,parts_db)
+        self._belt=belt
+
+    def load(self):
+        for t in sorted(self._belt.manifest['templates'].keys()):
+            if not self._db.has_key(t):
+                self._loadTemplate(t)
+        self._loaded=True
+
+    def rescan(self):
+        # belt file can't change under us
+        return [],[]
+
+    def newTemplate(self,template_id):
+        return KSPackedTemplate(template_id,os.path.join(self._path,template_id),self._parts_db,self._belt)
+
+    def __getitem__(self,k):
+        if not self._db.has_key(k):
+            if not self._belt.manifest['templates'].has_key(k):
+                raise KeyError(k)
+            self._loadTemplate(k)
+        return self._db[k]
 
 class Conveyor(object):
     _parts=None
     _templates=None
-
-    def __init__(self,parts_path='parts',parts_blacklist=[],parts_translate=False,templates_path='templates'):
-        self._parts=KSPartsDB(parts_path,parts_blacklist,parts_translate)
-        self._parts.load()
-        self._templates=KSTemplateDB(templates_path)
-        self._templates.load()
+    _index=None
+    _belt=None
+    # belt wide meta-var defaults
+    _vars_file=None
+
+    def __init__(self,parts_path='parts',parts_blacklist=[],parts_translate=False,templates_path='templates',index_path=None,belt_path=None):
+        if belt_path:
+            # packed belt, paths are only used to name parts the same
+            # way as when unpacked
+            self._belt=KSBelt(belt_path)
+            self._parts=KSPackedPartsDB(parts_path,self._belt,parts_translate)
+            self._templates=KSPackedTemplateDB(templates_path,self._belt,self._parts)
+            return
+        self._vars_file=KSVarsFile(os.path.join(os.path.dirname(parts_path),VARS_FILE))
+        if index_path:
+            self._index=KSPartIndex(index_path)
+            self._index.load()
+        # both DBs are populated lazily, see KSPartsDB.db and KSTemplateDB.db
+        self._parts=KSPartsDB(parts_path,parts_blacklist,parts_translate,self._index)
+        self._templates=KSTemplateDB(templates_path,self._index,self._parts)
 
     def renamePart(self,section,src_name,dst_name):
         ## Need to find out part's parent... hmm...
         ## also need to trace part in all templates
-        part=self._parts[section][src_name]
-        part.name=dst_name
+        # part first, so templates loaded by whereUsed() share it
+        self._parts[section][src_name]
+        users=self._templates.whereUsed(section,src_name)
+        part=self._parts.rename(section,src_name,dst_name)
         print(part.path)
-        for tid in self._templates.db.keys():
+        for tid in users:
             template=self._templates[tid]
-            if template.parts[section].has_key(src_name):
-                lpart=template.parts[section][src_name]
-                print(lpart.path,lpart.orig_path)
-                lpart.name=dst_name
-                lpart.setOrigPath(part.path)
+            lpart=template.parts[section][src_name]
+            print(lpart.path,lpart.orig_path)
+            lpart.name=dst_name
+            lpart.setOrigPath(part.path)
+            lpart.setSource(part)
+            template.parts[section][dst_name]=template.parts[section].pop(src_name)
+            self._templates.forgetLink(tid,section,src_name)
+            self._templates.noteLink(tid,section,dst_name)
 
     def addPart(self,template_id,section,name):
         part=self._parts[section][name]
         template=self._templates[template_id]
         template.addPart(section,part)
+        self._templates.noteLink(template_id,section,name)
+
+    def getVarDefaults(self):
+        """Meta-var values from VARS file in base dir"""
+        if self._belt is not None:
+            return self._belt.manifest.get('vars',{})
+        return self._vars_file.get()
+
+    def resetTemplates(self):
+        """Drop loaded templates, parts stay loaded. Not for packed belts"""
+        self._templates=KSTemplateDB(self._templates.path,self._index,self._parts)
+
+    def removePart(self,template_id,section,name):
+        template=self._templates[template_id]
+        template.removePart(section,name)
+        self._templates.forgetLink(template_id,section,name)
+
+    def attachPart(self,template_id,section,name):
+        """addPart() without touching disk, see KSTemplate.attachPart()"""
+        part=self._parts[section][name]
+        template=self._templates[template_id]
+        lpart=template.attachPart(section,part)
+        self._templates.noteLink(template_id,section,name)
+        return lpart
+
+    def detachPart(self,template_id,section,name):
+        """removePart() without touching disk"""
+        template=self._templates[template_id]
+        lpart=template.parts[section][name]
+        template.detachPart(section,name)
+        self._templates.forgetLink(template_id,section,name)
+        return lpart
+
+    def whereUsed(self,section,name):
+        return self._templates.whereUsed(section,name)
+
+    def saveIndex(self):
+        if self._index is not None:
+            self._index.save()
 
     def getParts(self):
         return self._parts
@@ -390,21 +1527,308 @@ class Conveyor(object):
     parts=property(getParts)
     templates=property(getTemplates)
 
+class KSSink(object):
+    """Buffered writer for assembled output. Target is anything with
+    write() (files, stdout, StringIO) or sendall() (sockets), None
+    stands for stdout"""
+    _write=None
+    _flush=None
+    _buf=None
+    _size=None
+    _bufsize=None
+
+    def __init__(self,target=None,bufsize=SINK_BUFSIZE):
+        if target is None:
+            target=sys.stdout
+        if hasattr(target,'sendall'):
+            self._write=target.sendall
+        else:
+            self._write=target.write
+            self._flush=getattr(target,'flush',None)
+        self._buf=[]
+        self._size=0
+        self._bufsize=bufsize
+
+    def write(self,chunk):
+        if len(chunk)>=self._bufsize:
+            # no point copying big chunks into the buffer
+            self._drain()
+            self._emit(chunk)
+            return
+        self._buf.append(chunk)
+        self._size+=len(chunk)
+        if self._size>=self._bufsize:
+            self._drain()
+
+    def _emit(self,data):
+        if _stats is None:
+            self._write(data)
+            return
+        t=time.time()
+        self._write(data)
+        _stats.add('output',time.time()-t)
+        _stats.count('bytes_written',len(data))
+
+    def _drain(self):
+        if self._buf:
+            self._emit(''.join(self._buf))
+            self._buf=[]
+            self._size=0
+
+    def flush(self):
+        self._drain()
+        if self._flush is not None:
+            self._flush()
+
+class KSAssemblyCache(object):
+    """Content addressed store of assembled kickstarts. Keys are
+    computed by the caller, see KSAssembler.assemblyKey()"""
+    _path=None
+
+    def __init__(self,path):
+        self._path=path
+
+    def _entryPath(self,key):
+        return os.path.join(self._path,key[:2],key)
+
+    def get(self,key):
+        try:
+            f=open(self._entryPath(key),'rb')
+        except IOError:
+            return None
+        data=f.read()
+        f.close()
+        return data
+
+    def put(self,key,data):
+        """Store data under key. Failures are ignored, cache is optional"""
+        entry_path=self._entryPath(key)
+        try:
+            entry_dir=os.path.dirname(entry_path)
+            if not os.path.isdir(entry_dir):
+                os.makedirs(entry_dir)
+            replace_file(entry_path,data)
+        except (IOError,OSError):
+            pass
+
 class KSAssembler(object):
     _base_dir=None
     _ignore_dirs=None
     _translate=None
     _conveyor=None
-
-    def __init__(self,base_dir,ignore_dirs):
+    _cache=None
+    # threads reading parts ahead of assembly, see setIOWorkers()
+    _io_workers=None
+    _io_pool=None
+    _use_index=None
+    _belt_file=None
+    # directory mtimes loaded state was checked against, see refresh()
+    _mtimes=None
+    # meta-var layers on top of belt defaults, see setVarSources()
+    _host_vars=None
+    _var_overrides=None
+    # LRUCache of translated parts, see setPartCache()
+    _part_cache=None
+
+    def __init__(self,base_dir,ignore_dirs,use_index=True,belt_file=None):
+        """With belt_file the belt is loaded (read-only) from a file
+        written by pack() instead of base_dir"""
         self._base_dir=base_dir
         self._ignore_dirs=ignore_dirs
         self._translate=False
+        self._io_workers=1
+        self._use_index=use_index
+        self._belt_file=belt_file
+        self._newConveyor()
+
+    def _newConveyor(self):
         templates_dir=os.path.join(self._base_dir,'templates')
         parts_dir=os.path.join(self._base_dir,'parts')
-        self._conveyor=Conveyor(parts_dir,self._ignore_dirs,templates_dir)
+        if self._use_index and not self._belt_file:
+            index_path=os.path.join(self._base_dir,INDEX_FILE)
+        else:
+            index_path=None
+        self._conveyor=Conveyor(parts_dir,self._ignore_dirs,templates_path=templates_dir,index_path=index_path,belt_path=self._belt_file)
+
+    def _beltMtimes(self):
+        """{path: mtime} of directories listing parts, templates and
+        links of loaded templates and of their READMEs (or just of the
+        packed belt file)"""
+        def _mtime(path):
+            try:
+                return os.stat(path).st_mtime
+            except OSError:
+                return None
+        if self._belt_file:
+            return {self._belt_file:_mtime(self._belt_file)}
+        parts=self._conveyor.parts
+        templates=self._conveyor.templates
+        mtimes={templates.path:_mtime(templates.path)}
+        for s in SECTIONS:
+            s_path=parts.sectionPath(s)
+            mtimes[s_path]=_mtime(s_path)
+        for tid in templates.loadedIDs():
+            for s in SECTIONS:
+                s_path=os.path.join(templates.path,tid,s)
+                mtimes[s_path]=_mtime(s_path)
+            info_path=os.path.join(templates.path,tid,'README')
+            mtimes[info_path]=_mtime(info_path)
+        return mtimes
+
+    def refresh(self):
+        """Drop loaded state not matching the belt on disk any more, for
+        long running processes. Part contents are revalidated on every
+        read anyway, here directory mtimes are compared with the last
+        call: new or removed parts (or repacked belt file) reload
+        everything, new or removed templates reload template DB and
+        changed links or README reload just that template. Returns True if
+        anything was dropped"""
+        old=self._mtimes
+        new=self._beltMtimes()
+        self._mtimes=new
+        if old is None:
+            return False
+        templates=self._conveyor.templates
+        changed=[p for p in new.keys() if old.has_key(p) and old[p]!=new[p]]
+        if not changed:
+            return False
+        parts_paths=set([self._conveyor.parts.sectionPath(s) for s in SECTIONS])
+        if self._belt_file or parts_paths.intersection(changed):
+            self._conveyor.saveIndex()
+            self._newConveyor()
+        elif templates.path in changed:
+            self._conveyor.resetTemplates()
+        else:
+            for tid in set([os.path.basename(os.path.dirname(p)) for p in changed]):
+                templates.reload(tid)
+        self.setTranslate(self._translate)
+        self._mtimes=self._beltMtimes()
+        return True
+
+    def close(self):
+        """Persist whatever was learned about parts"""
+        self._conveyor.saveIndex()
+        self.setIOWorkers(1)
+
+    def setIOWorkers(self,workers):
+        """Read all parts of a template with this many threads before it
+        gets assembled, so on high latency storage (NFS) assembly waits
+        for the slowest read rather than for sum of them. 1 reads parts
+        one by one as they are emitted"""
+        if self._io_pool is not None:
+            self._io_pool.close()
+            self._io_pool.join()
+            self._io_pool=None
+        self._io_workers=workers
+
+    def _prefetch(self,parts):
+        """Read resolved parts concurrently, returns once all are in"""
+        if self._io_workers<=1:
+            return
+        sources=set()
+        for s in parts.keys():
+            for p in parts[s].values():
+                sources.add(p.getSource())
+        if len(sources)<=1:
+            return
+        if self._io_pool is None:
+            self._io_pool=ThreadPool(self._io_workers)
+        def _fetch(part):
+            # overlapping per thread times would add up beyond wall time
+            if _stats is not None:
+                _stats.ignorePhases()
+            part.prefetch()
+        if _stats is not None:
+            t=time.time()
+        self._io_pool.map(_fetch,list(sources))
+        if _stats is not None:
+            _stats.add('read',time.time()-t)
+
+    def setStats(self,stats):
+        """Collect per-phase timings and I/O counters into stats (a
+        KSStats instance). Collection is process wide, None disables it"""
+        set_stats(stats)
+
+    def setCache(self,cache_dir):
+        """Enable assembled kickstarts cache in cache_dir (BASE_DIR/"""+CACHE_DIR+""" when
+        True), None disables it"""
+        if cache_dir is True:
+            cache_dir=os.path.join(self._base_dir,CACHE_DIR)
+        if cache_dir:
+            self._cache=KSAssemblyCache(cache_dir)
+        else:
+            self._cache=None
 
 
+    def setVarSources(self,host_vars=None,overrides=None):
+        """Extra meta-var layers: host_vars file (KEY=value lines, see
+        parse_vars()) and overrides mapping (--var) taking precedence
+        over everything"""
+        if host_vars:
+            self._host_vars=KSVarsFile(host_vars)
+        else:
+            self._host_vars=None
+        self._var_overrides=overrides
+
+    def resolveVars(self,template_id,variables=None):
+        """Meta-vars for assembling template_id as KSVars. Layers, lowest
+        precedence first: BASE_DIR/VARS, templates/<id>/VARS, host vars
+        file, Environment (or variables mapping standing for it) and
+        overrides"""
+        if variables is None:
+            variables=os.environ
+        if self._host_vars is not None:
+            host_vars=self._host_vars.get()
+        else:
+            host_vars=None
+        return KSVars([('defaults',self._conveyor.getVarDefaults()),
+                       ('template',self._conveyor.templates[template_id].getVarDefaults()),
+                       ('host',host_vars),
+                       ('env',variables),
+                       ('var',self._var_overrides)])
+
+    def setPartCache(self,size):
+        """Keep up to size bytes of translated parts in memory, keyed by
+        part's source, content hash and values of just the vars the part
+        uses. Parts not depending on per-host vars get translated once
+        for all hosts. 0 or None disables it"""
+        if size:
+            # daemon sets it on every request, keep what's cached
+            if self._part_cache is None or self._part_cache.maxsize!=size:
+                self._part_cache=LRUCache(size,len)
+        else:
+            self._part_cache=None
+
+    def getPartCacheSize(self):
+        """Size limit of part cache in bytes, 0 when disabled"""
+        if self._part_cache is None:
+            return 0
+        return self._part_cache.maxsize
+
+    def _partChunks(self,part,variables):
+        """Part's text in chunks, translated parts go through part cache
+        when it is enabled"""
+        if self._part_cache is None or not self._translate:
+            return part.chunks(variables)
+        key=part.cacheKey(variables)
+        text=self._part_cache.get(key)
+        if text is not None:
+            if _stats is not None:
+                _stats.count('part_cache_hits')
+            return [text]
+        return self._cachePart(key,part.chunks(variables))
+
+    def _cachePart(self,key,chunks):
+        # streamed (big) parts come in more chunks and are not kept
+        n=0
+        for chunk in chunks:
+            if n==0:
+                first=chunk
+            n+=1
+            yield chunk
+        if n==1:
+            self._part_cache.put(key,first)
+
     def setTranslate(self,trans):
         self._translate=trans
         self._conveyor.parts.setTranslateAll(trans)
@@ -413,7 +1837,7 @@ class KSAssembler(object):
     def setup(self,template_id):
         t=self._conveyor.templates.newTemplate(template_id)
         t.init()
-        self._conveyor.templates.db[template_id]=t
+        self._conveyor.templates[template_id]=t
 
     def lsparts(self,list_vars=False):
         for s in SECTIONS:
@@ -439,6 +1863,16 @@ class KSAssembler(object):
         lprefix="\n"+prefix
         print(prefix+lprefix.join(lines))
 
+    def _templateIDs(self,filter=None):
+        """Sorted IDs of all templates, optionally only those matching
+        filter regexp (same as lstemplates)"""
+        t_list=self._conveyor.templates.db.keys()
+        if filter:
+            re_filter=re.compile(filter)
+            t_list=[t for t in t_list if re_filter.search(t)]
+        t_list.sort()
+        return t_list
+
     def lstemplates(self,filter=None,list_parts=False,list_vars=False,list_all_parts=False,list_info=False):
         if filter:
             re_filter=re.compile(filter)
@@ -525,25 +1959,339 @@ class KSAssembler(object):
             if not parts.has_key(s):
                 continue
             for p in parts[s]:
-                part=self._conveyor.parts[s][p]
-                self._conveyor.templates[template_id].addPart(s,part)
+                self._conveyor.addPart(template_id,s,p)
 
     def addpart(self,template_id,section,parts):
         for part_id in parts:
             self._conveyor.addPart(template_id,section,part_id)
 
+    def rmpart(self,template_id,section,parts):
+        for part_id in parts:
+            self._conveyor.removePart(template_id,section,part_id)
+
     def mvpart(self,section,src_part_id,dst_part_id):
         self._conveyor.renamePart(section,src_part_id,dst_part_id)
 
+    def _checkOperations(self,operations):
+        """Raise ValueError listing every operation referring to unknown
+        template, section or part, or creating template which already
+        exists. Renames and templates created by earlier operations are
+        taken into account"""
+        errors=[]
+        names={}
+        for s in SECTIONS:
+            names[s]=set(self._conveyor.parts[s].keys())
+        templates=set(self._conveyor.templates.db.keys())
+        def _need_part(where,section,part_id):
+            if not names.has_key(section):
+                errors.append("{0}: unknown section {1}".format(where,section))
+            elif not part_id in names[section]:
+                errors.append("{0}: unknown part {1}:{2}".format(where,section,part_id))
+        def _need_template(where,template_id):
+            if not template_id in templates:
+                errors.append("{0}: unknown template {1}".format(where,template_id))
+        def _new_template(where,template_id):
+            if template_id in templates or \
+                    os.path.lexists(os.path.join(self._conveyor.templates.path,template_id)):
+                errors.append("{0}: template {1} already exists".format(where,template_id))
+            templates.add(template_id)
+        for n,op in enumerate(operations):
+            kind=op.get('op')
+            where="operation {0} ({1})".format(n+1,kind)
+            try:
+                if kind=='create':
+                    for s,p_list in op.get('parts',{}).items():
+                        for p in p_list:
+                            _need_part(where,s,p)
+                    _new_template(where,op['template'])
+                elif kind=='clone':
+                    _need_template(where,op['src'])
+                    _new_template(where,op['dst'])
+                elif kind in ('addpart','rmpart'):
+                    _need_template(where,op['template'])
+                    for p in op['parts']:
+                        _need_part(where,op['section'],p)
+                elif kind=='mvpart':
+                    _need_part(where,op['section'],op['src'])
+                    if names.has_key(op['section']):
+                        if op['dst'] in names[op['section']]:
+                            errors.append("{0}: part {1}:{2} already exists".format(where,op['section'],op['dst']))
+                        names[op['section']].discard(op['src'])
+                        names[op['section']].add(op['dst'])
+                else:
+                    errors.append("{0}: unknown operation".format(where))
+            except KeyError as e:
+                errors.append("{0}: missing {1}".format(where,e))
+        if errors:
+            raise ValueError("Invalid operations:\n  "+"\n  ".join(errors))
+
+    def apply(self,operations):
+        """Run template operations (see load_operations()) against the
+        belt loaded once. Everything is validated first, nothing changes
+        if any operation refers to unknown template or part. Adding a
+        part already linked or removing one that is not is a no-op.
+        Links are changed in memory and written out in one pass at the
+        end (and before renames, which relink on disk)"""
+        self._checkOperations(operations)
+        conveyor=self._conveyor
+        # (template_id,section,part_id) -> (add,KSPartL) links to change
+        pending=OrderedDict()
+        def _link(template_id,section,part_id):
+            if conveyor.templates[template_id].parts[section].has_key(part_id):
+                return
+            lpart=conveyor.attachPart(template_id,section,part_id)
+            key=(template_id,section,part_id)
+            # link removed earlier in this run is still on disk
+            if pending.pop(key,None) is None:
+                pending[key]=(True,lpart)
+        def _unlink(template_id,section,part_id):
+            if not conveyor.templates[template_id].parts[section].has_key(part_id):
+                return
+            lpart=conveyor.detachPart(template_id,section,part_id)
+            key=(template_id,section,part_id)
+            if pending.pop(key,None) is None:
+                pending[key]=(False,lpart)
+        def _flush():
+            for add,lpart in pending.values():
+                if add:
+                    lpart.materialize()
+                else:
+                    os.unlink(lpart.path)
+            pending.clear()
+        for op in operations:
+            kind=op['op']
+            if kind=='create':
+                self.setup(op['template'])
+                for s,p_list in op.get('parts',{}).items():
+                    for p in p_list:
+                        _link(op['template'],s,p)
+            elif kind=='clone':
+                src=conveyor.templates[op['src']]
+                self.setup(op['dst'])
+                for s in src.parts.keys():
+                    for p in src.parts[s].keys():
+                        _link(op['dst'],s,p)
+            elif kind=='addpart':
+                for p in op['parts']:
+                    _link(op['template'],op['section'],p)
+            elif kind=='rmpart':
+                for p in op['parts']:
+                    _unlink(op['template'],op['section'],p)
+            elif kind=='mvpart':
+                _flush()
+                conveyor.renamePart(op['section'],op['src'],op['dst'])
+        _flush()
+
+    def whereused(self,section,part_id):
+        for t in self._conveyor.whereUsed(section,part_id):
+            print(t)
+
+    def pack(self,belt_file):
+        pack_belt(self._conveyor,belt_file)
+
+    def unpack(self,output_dir):
+        unpack_belt(self._conveyor,output_dir)
+
     def clone(self,src_template_id,dst_template_id):
         template=self._conveyor.templates[src_template_id]
         self.setup(dst_template_id)
         for s in template.parts.keys():
             section=template.parts[s]
             for p in section.keys():
-                part=self._conveyor.parts[s][p]
-                self._conveyor.templates[dst_template_id].addPart(s,part)
+                self._conveyor.addPart(dst_template_id,s,p)
+
+
+    def _renderTo(self,ks_path,template_id,pkg_opts,**kwargs):
+        """Assemble into ks_path, leaving the file alone if its content
+        would not change. Returns True when file was written"""
+        data=''.join(self._cachedChunks(template_id,pkg_opts,**kwargs))
+        return write_if_changed(ks_path,data)
+
+    def assembleAll(self,output_dir,pkg_opts,filter=None,jobs=1,**kwargs):
+        """Render every template (matching filter regexp, as in
+        lstemplates) into output_dir/<template>.ks. Files whose content
+        would not change are left alone. With jobs>1 rendering is done
+        by a pool of worker processes. Returns list of written files"""
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        t_ids=self._templateIDs(filter)
+        ks_jobs=[(os.path.join(output_dir,tid+'.ks'),tid,pkg_opts,kwargs) for tid in t_ids]
+        if jobs>1:
+            for tid in t_ids:
+                self.preload(tid,kwargs.get('extra_parts'),kwargs.get('exclude_parts'))
+        return [ks_path for ks_path in self._runJobs(ks_jobs,jobs,changed_only=True) if ks_path]
+
+    def _watchPaths(self,template_ids):
+        """Paths watch mode polls: {path: set of template IDs depending
+        on it}. Template section dirs change when links are added or
+        removed, part sources when parts are edited. Targets of broken
+        links are watched for coming back"""
+        templates=self._conveyor.templates
+        paths={templates.path:set(),
+               os.path.join(self._base_dir,VARS_FILE):set(template_ids)}
+        for tid in template_ids:
+            try:
+                template=templates[tid]
+            except (OSError,IOError,KeyError):
+                # failed to load (see watch()), wait for its links to change
+                for s in SECTIONS:
+                    paths.setdefault(os.path.join(templates.path,tid,s),set()).add(tid)
+                continue
+            paths[os.path.join(template.path,VARS_FILE)]=set([tid])
+            for s in SECTIONS:
+                paths.setdefault(os.path.join(template.path,s),set()).add(tid)
+            for s in template.parts.keys():
+                for p in template.parts[s].keys():
+                    paths.setdefault(template.parts[s][p].orig_path,set()).add(tid)
+            for s,p,kind,target in template.problems:
+                if kind=='broken':
+                    paths.setdefault(target,set()).add(tid)
+        return paths
+
+    def watch(self,output_dir,pkg_opts,filter=None,interval=2.0,legacy_mode=False,iterations=None):
+        """Keep output_dir/<template>.ks up to date: render everything
+        once, then poll mtimes every interval seconds and re-render only
+        templates whose links or parts changed. Templates failing to
+        render are reported on stderr and retried on their next change.
+        Runs forever unless iterations (number of polls) is given"""
+        def _mtime(path):
+            try:
+                return os.stat(path).st_mtime
+            except OSError:
+                return None
 
+        def _render(tid,reload=False):
+            ks_path=os.path.join(output_dir,tid+'.ks')
+            try:
+                if reload:
+                    templates.reload(tid)
+                written=self._renderTo(ks_path,tid,pkg_opts,legacy_mode=legacy_mode)
+            except (OSError,IOError,KeyError) as e:
+                print("Error: template {0}: {1}".format(tid,e),file=sys.stderr)
+                return
+            if written:
+                print(ks_path)
+                sys.stdout.flush()
+
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        templates=self._conveyor.templates
+        t_ids=self._templateIDs(filter)
+        for tid in t_ids:
+            _render(tid)
+        paths=self._watchPaths(t_ids)
+        mtimes={}
+        for p in paths.keys():
+            mtimes[p]=_mtime(p)
+
+        n=0
+        while iterations is None or n<iterations:
+            n+=1
+            time.sleep(interval)
+            changed=set()
+            new_mtimes={}
+            for p in paths.keys():
+                new_mtimes[p]=_mtime(p)
+                if new_mtimes[p]!=mtimes.get(p):
+                    changed.add(p)
+            if not changed:
+                continue
+            affected=set()
+            reload_ids=set()
+            for p in changed:
+                if p==templates.path:
+                    added,removed=templates.rescan()
+                    for tid in removed:
+                        ks_path=os.path.join(output_dir,tid+'.ks')
+                        if os.path.exists(ks_path):
+                            os.unlink(ks_path)
+                    t_ids=self._templateIDs(filter)
+                    affected.update([t for t in added if t in t_ids])
+                elif os.path.dirname(p) in [os.path.join(templates.path,t) for t in paths[p]]:
+                    reload_ids.update(paths[p])
+                elif new_mtimes[p] is None or mtimes.get(p) is None:
+                    # part source removed or back, links need resolving again
+                    self._conveyor.parts.rescanPart(p)
+                    reload_ids.update(paths[p])
+                else:
+                    affected.update(paths[p])
+            affected.update(reload_ids)
+            affected.intersection_update(t_ids)
+            for tid in sorted(affected):
+                _render(tid,tid in reload_ids)
+            paths=self._watchPaths(t_ids)
+            for p in paths.keys():
+                if not new_mtimes.has_key(p):
+                    new_mtimes[p]=_mtime(p)
+            mtimes=new_mtimes
+
+    def preload(self,template_id,extra_parts=None,exclude_parts=None):
+        """Read every part template_id assembles from, so forked worker
+        processes start with part contents already in memory"""
+        template=self._conveyor.templates[template_id]
+        parts=self._resolveParts(template,extra_parts,exclude_parts)
+        # scanVars() may be answered by the index without reading
+        sources=set()
+        for s in parts.keys():
+            for p in parts[s].values():
+                sources.add(p.getSource())
+        for source in sources:
+            source.prefetch()
+
+    def _assembleTo(self,ks_path,template_id,pkg_opts,**kwargs):
+        f=open(ks_path,'w')
+        self.assemble(template_id,pkg_opts,out=f,**kwargs)
+        f.close()
+        return ks_path
+
+    def _runJob(self,job,changed_only=False):
+        """Assemble (ks_path,template_id,pkg_opts,kwargs) job, returns
+        ks_path. With changed_only files whose content would not change
+        are left alone and None is returned for them"""
+        ks_path,template_id,pkg_opts,kwargs=job
+        if not changed_only:
+            return self._assembleTo(ks_path,template_id,pkg_opts,**kwargs)
+        if self._renderTo(ks_path,template_id,pkg_opts,**kwargs):
+            return ks_path
+        return None
+
+    def _runJobs(self,ks_jobs,jobs=1,changed_only=False):
+        """Run (ks_path,template_id,pkg_opts,kwargs) jobs, spreading
+        them over a process pool when jobs>1. Returns _runJob() results
+        in job order"""
+        if jobs<=1 or len(ks_jobs)<=1:
+            return [self._runJob(job,changed_only) for job in ks_jobs]
+        pool=multiprocessing.Pool(min(jobs,len(ks_jobs)),_init_worker,(self,))
+        try:
+            written=pool.map(_assemble_worker,[(job,changed_only) for job in ks_jobs],
+                             chunksize=max(1,len(ks_jobs)//(jobs*4)))
+        finally:
+            pool.close()
+            pool.join()
+        return written
+
+    def assembleBatch(self,template_id,pkg_opts,hosts,output_dir,var_summary=False,extra_parts=None,exclude_parts=None,legacy_mode=False,jobs=1):
+        """Assemble template once per host into output_dir/<host>.ks
+        hosts is a list of (host_id,vars) pairs, host vars take precedence
+        over environment. With jobs>1 rendering is done by a pool of
+        worker processes. Returns list of written files"""
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        ks_jobs=[]
+        for host_id,host_vars in hosts:
+            if os.path.sep in host_id or host_id in ('',os.curdir,os.pardir):
+                raise ValueError("Invalid host ID: {0!r}".format(host_id))
+            variables=KSVars([('env',os.environ),('manifest',host_vars)])
+            ks_path=os.path.join(output_dir,host_id+'.ks')
+            ks_jobs.append((ks_path,template_id,pkg_opts,
+                            dict(var_summary=var_summary,
+                                 extra_parts=extra_parts,
+                                 exclude_parts=exclude_parts,
+                                 legacy_mode=legacy_mode,
+                                 variables=variables)))
+        if jobs>1:
+            self.preload(template_id,extra_parts,exclude_parts)
+        return self._runJobs(ks_jobs,jobs)
 
     def info(self,template_id,var_summary=False):
         template=self._conveyor.templates[template_id]
@@ -553,65 +2301,65 @@ class KSAssembler(object):
             print("")
         
 
-    def assemble(self,template_id,pkg_opts,var_summary=False,dry_run=False,extra_parts=None,exclude_parts=None,legacy_mode=False):
-        template=self._conveyor.templates[template_id]
-        ks_commands=template.parts['commands']
-        ks_packages=template.parts['packages']
-        ks_pre=template.parts['pre']
-        ks_post=template.parts['post']
-        ks_post_header=template.parts['post.header']
-
+    def _resolveParts(self,template,extra_parts=None,exclude_parts=None):
+        """Template's parts with extras added and excludes removed.
+        Works on a copy, template itself is left untouched so it can
+        be assembled again"""
+        parts={}
+        for s in template.parts.keys():
+            parts[s]=dict(template.parts[s])
         if extra_parts:
             for s in extra_parts.keys():
                 for p in extra_parts[s]:
-                    part=self._conveyor.parts[s][p]
-                    template.attachPart(s,part,part_type=KSPartV)
-                    new_part=template.parts[s][p]
-                    new_part.setTranslate(self._translate)
-
+                    parts[s][p]=self._conveyor.parts[s][p]
         if exclude_parts:
             for s in exclude_parts.keys():
                 for p in exclude_parts[s]:
-                    template.detachPart(s,p)
+                    del parts[s][p]
+        return parts
 
-        print("## Auto-generated by conveyor line\n")
-        print("##TEMPLATE: "+template_id)
+    def assembleChunks(self,template_id,pkg_opts,var_summary=False,dry_run=False,extra_parts=None,exclude_parts=None,legacy_mode=False,variables=None):
+        """Generate assembled KS as a sequence of text chunks. Meta-vars
+        are resolved by resolveVars(), variables mapping standing for
+        Environment when given"""
+        template=self._conveyor.templates[template_id]
+        parts=self._resolveParts(template,extra_parts,exclude_parts)
+        self._prefetch(parts)
+        ks_commands=parts['commands']
+        ks_packages=parts['packages']
+        ks_pre=parts['pre']
+        ks_post=parts['post']
+        ks_post_header=parts['post.header']
+
+        yield "## Auto-generated by conveyor line\n\n"
+        yield "##TEMPLATE: "+template_id+"\n"
         if extra_parts:
-            print("##EXTRAS: "+"{0}".format(" ".join(["{0}:{1}".format(s,",".join(extra_parts[s])) for s in extra_parts.keys()])))
+            yield "##EXTRAS: "+"{0}".format(" ".join(["{0}:{1}".format(s,",".join(extra_parts[s])) for s in extra_parts.keys()]))+"\n"
         if exclude_parts:
-            print("##EXCLUDES: "+"{0}".format(" ".join(["{0}:{1}".format(s,",".join(exclude_parts[s])) for s in exclude_parts.keys()])))
+            yield "##EXCLUDES: "+"{0}".format(" ".join(["{0}:{1}".format(s,",".join(exclude_parts[s])) for s in exclude_parts.keys()]))+"\n"
 
-        print("##LEGACY MODE: {0}".format("On" if legacy_mode else "Off"))
-        print("")
+        yield "##LEGACY MODE: {0}\n".format("On" if legacy_mode else "Off")
+        yield "\n"
 
-        ignore_dirs=self._ignore_dirs
         all_vars_s=set()
-        for s in template.parts.keys():
-            for p in template.parts[s].keys():
-                for v in template.parts[s][p].scanVars():
+        for s in parts.keys():
+            for p in parts[s].keys():
+                for v in parts[s][p].scanVars():
                     all_vars_s.add(v)
         all_vars=list(all_vars_s)
         all_vars.sort()
         if var_summary:
-            print("##All vars: "+" ".join(all_vars))
+            yield "##All vars: "+" ".join(all_vars)+"\n"
 
         if dry_run:
             return
 
-        
         if self._translate:
-            remaining_vars=all_vars_s
-            vars_summary={}
-            for s in template.parts.keys():
-                for p in template.parts[s].keys():
-                    p_vars=template.parts[s][p].varSubs()
-                    vars_summary.update(p_vars)
-            print("##Supplied vars: {0}".format(' '.join(["{0}=\"{1}\"".format(k,vars_summary[k]) for k in vars_summary.keys()])))
-            for v in vars_summary.keys():
-                remaining_vars.remove(v)
-            remaining_vars_list=list(remaining_vars)
-            remaining_vars_list.sort()
-            print("##Remaining vars: {0}\n".format(" ".join(remaining_vars_list)))
+            variables=self.resolveVars(template_id,variables)
+            supplied=[v for v in all_vars if variables.get(v)]
+            yield "##Supplied vars: {0}\n".format(' '.join(["{0}=\"{1}\"({2})".format(v,variables[v],variables.origin(v)) for v in supplied]))
+            remaining_vars_list=[v for v in all_vars if not variables.get(v)]
+            yield "##Remaining vars: {0}\n\n".format(" ".join(remaining_vars_list))
 
         def cat(my_parts,section_name=None):
             my_parts_keys=my_parts.keys()
@@ -622,50 +2370,735 @@ class KSAssembler(object):
                 s_name=''
             for k in my_parts_keys:
                 my_part=my_parts[k]
-                print('##PART: {0}{1}'.format(s_name,my_part.name))
-                for l in my_part.lines():
-                    print(l,end='')
-                # the_cat(my_part.path)
+                yield '##PART: {0}{1}\n'.format(s_name,my_part.name)
+                for chunk in self._partChunks(my_part,variables):
+                    yield chunk
 
-        cat(ks_commands,'commands')
+        for chunk in cat(ks_commands,'commands'):
+            yield chunk
 
-        print("\n%packages "+pkg_opts)
-        cat(ks_packages,'packages')
-        if not legacy_mode: print("%end\n")
+        yield "\n%packages "+pkg_opts+"\n"
+        for chunk in cat(ks_packages,'packages'):
+            yield chunk
+        if not legacy_mode: yield "%end\n\n"
 
         ks_pre_keys=ks_pre.keys()
         ks_pre_keys.sort()
         for k in ks_pre_keys:
             my_pre=ks_pre[k]
-            print("\n%pre")
-            print('##PART: pre:{0}'.format(my_pre.name))
-            for l in my_pre.lines():
-                print(l,end='')
-            if not legacy_mode: print("\n%end")
+            yield "\n%pre\n"
+            yield '##PART: pre:{0}\n'.format(my_pre.name)
+            for chunk in self._partChunks(my_pre,variables):
+                yield chunk
+            if not legacy_mode: yield "\n%end\n"
 
         ks_post_keys=ks_post.keys()
         ks_post_keys.sort()
+        # same header goes into every %post, render it just once
+        if ks_post_keys:
+            post_header=''.join(cat(ks_post_header,'post.header'))
         for k in ks_post_keys:
             my_post=ks_post[k]
-            print("\n%post --erroronfail --log=/root/anaconda-"+k+".log")
-            cat(ks_post_header,'post.header')
-            print('##PART: post:{0}'.format(my_post.name))
-            for l in my_post.lines():
-                print(l,end='')
-            if not legacy_mode: print("\n%end")
+            yield "\n%post --erroronfail --log=/root/anaconda-"+k+".log\n"
+            yield post_header
+            yield '##PART: post:{0}\n'.format(my_post.name)
+            for chunk in self._partChunks(my_post,variables):
+                yield chunk
+            if not legacy_mode: yield "\n%end\n"
+
+    def assemblyKey(self,template_id,pkg_opts,var_summary,dry_run,extra_parts,exclude_parts,legacy_mode,variables):
+        """Cache key: everything assembled output depends on, parts are
+        represented by their content hashes and variables by values of
+        just the ones parts use"""
+        template=self._conveyor.templates[template_id]
+        parts=self._resolveParts(template,extra_parts,exclude_parts)
+        self._prefetch(parts)
+        parts_key=[]
+        used_vars=set()
+        s_list=parts.keys()
+        s_list.sort()
+        for s in s_list:
+            p_list=parts[s].keys()
+            p_list.sort()
+            for p in p_list:
+                part=parts[s][p]
+                parts_key.append((s,p,part.getDigest()))
+                used_vars.update(part.scanVars())
+        vars_key=[]
+        if self._translate:
+            variables=self.resolveVars(template_id,variables)
+            used_vars_list=list(used_vars)
+            used_vars_list.sort()
+            for v in used_vars_list:
+                vars_key.append((v,variables.get(v),variables.origin(v)))
+        key_data=(template_id,pkg_opts,var_summary,dry_run,
+                  extra_parts,exclude_parts,legacy_mode,self._translate,
+                  parts_key,vars_key)
+        return hashlib.sha1(json.dumps(key_data,sort_keys=True)).hexdigest()
+
+    def assemble(self,template_id,pkg_opts,var_summary=False,dry_run=False,extra_parts=None,exclude_parts=None,legacy_mode=False,variables=None,out=None):
+        """Assemble KS into out: anything with write() (file, StringIO),
+        a socket, or None for stdout. See assembleChunks()"""
+        sink=KSSink(out)
+        for chunk in self._cachedChunks(template_id,pkg_opts,var_summary,dry_run,
+                                        extra_parts,exclude_parts,legacy_mode,variables):
+            sink.write(chunk)
+        sink.flush()
+
+    def _cachedChunks(self,template_id,pkg_opts,var_summary=False,dry_run=False,extra_parts=None,exclude_parts=None,legacy_mode=False,variables=None):
+        """assembleChunks() going through assembly cache when enabled"""
+        chunks=self.assembleChunks(template_id,pkg_opts,
+                                   var_summary=var_summary,
+                                   dry_run=dry_run,
+                                   extra_parts=extra_parts,
+                                   exclude_parts=exclude_parts,
+                                   legacy_mode=legacy_mode,
+                                   variables=variables)
+        if self._cache is None:
+            return chunks
+        key=self.assemblyKey(template_id,pkg_opts,var_summary,dry_run,
+                             extra_parts,exclude_parts,legacy_mode,variables)
+        data=self._cache.get(key)
+        if data is None:
+            data=''.join(chunks)
+            self._cache.put(key,data)
+        return [data]
+
+
+class LRUCache(object):
+    """Thread safe mapping keeping most recently used entries of total
+    size up to maxsize. Size of an entry is sizeof(value), 1 by default,
+    so maxsize is then the number of entries"""
+    _maxsize=None
+    _sizeof=None
+    # key -> (value,size), oldest first
+    _db=None
+    _total=None
+    _lock=None
+
+    def __init__(self,maxsize,sizeof=None):
+        self._maxsize=maxsize
+        self._sizeof=sizeof
+        self._db=OrderedDict()
+        self._total=0
+        self._lock=threading.Lock()
+
+    def get(self,key,default=None):
+        with self._lock:
+            try:
+                item=self._db.pop(key)
+            except KeyError:
+                return default
+            self._db[key]=item
+            return item[0]
+
+    def put(self,key,value):
+        if self._sizeof is None:
+            size=1
+        else:
+            size=self._sizeof(value)
+        if size>self._maxsize:
+            return
+        with self._lock:
+            old=self._db.pop(key,None)
+            if old is not None:
+                self._total-=old[1]
+            self._db[key]=(value,size)
+            self._total+=size
+            while self._total>self._maxsize:
+                old_key,old=self._db.popitem(last=False)
+                self._total-=old[1]
+
+    def __len__(self):
+        return len(self._db)
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+class KSRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves /ks/<template>?VAR=value&extra=post:foo&exclude=pre:bar
+    Reserved query args: extra, exclude (parts spec, may repeat),
+    legacy (1 enables legacy mode), opts (%packages options), anything
+    else is a meta-var overriding Environment"""
+
+    def do_GET(self):
+        url=urlparse.urlparse(self.path)
+        if not url.path.startswith('/ks/'):
+            self.send_error(404)
+            return
+        template_id=urllib.unquote(url.path[len('/ks/'):])
+        extra_specs=[]
+        exclude_specs=[]
+        legacy_mode=False
+        pkg_opts=self.server.pkg_opts
+        query_vars={}
+        for k,v in urlparse.parse_qsl(url.query,keep_blank_values=True):
+            if k=='extra':
+                extra_specs.append(v)
+            elif k=='exclude':
+                exclude_specs.append(v)
+            elif k=='legacy':
+                legacy_mode=v.lower() in ('1','yes','true','on')
+            elif k=='opts':
+                pkg_opts=v
+            else:
+                query_vars[k]=v
+        variables=KSVars([('env',os.environ),('query',query_vars)])
+        try:
+            extra_parts=None
+            if extra_specs:
+                extra_parts=parse_parts_spec(';'.join(extra_specs))
+            exclude_parts=None
+            if exclude_specs:
+                exclude_parts=parse_parts_spec(';'.join(exclude_specs))
+            key,entry=self.server.render(template_id,pkg_opts,extra_parts,exclude_parts,legacy_mode,variables)
+        except KeyError as e:
+            self.send_error(404,"Unknown template or part: {0}".format(e))
+            return
+        except (IndexError,ValueError) as e:
+            self.send_error(400,str(e))
+            return
+        except (OSError,IOError) as e:
+            # part or template vanished under us
+            self.send_error(500,str(e))
+            return
+
+        use_gzip=accepts_gzip(self.headers.get('Accept-Encoding',''))
+        # gzipped body is a different representation, needs its own tag
+        if use_gzip:
+            etag='"{0}-gz"'.format(key)
+        else:
+            etag='"{0}"'.format(key)
+        inm=self.headers.get('If-None-Match')
+        if inm and (inm.strip()=='*' or etag in [t.strip() for t in inm.split(',')]):
+            self.send_response(304)
+            self.send_header('ETag',etag)
+            self.send_header('Vary','Accept-Encoding')
+            self.end_headers()
+            return
+
+        body=entry['body']
+        if use_gzip:
+            if entry.get('gzip') is None:
+                buf=StringIO()
+                gz=gzip.GzipFile(fileobj=buf,mode='wb')
+                gz.write(body)
+                gz.close()
+                entry['gzip']=buf.getvalue()
+            body=entry['gzip']
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; charset=utf-8')
+        self.send_header('Content-Length',str(len(body)))
+        self.send_header('ETag',etag)
+        self.send_header('Vary','Accept-Encoding')
+        if use_gzip:
+            self.send_header('Content-Encoding','gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+class KSServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    """Kickstart HTTP server around one loaded KSAssembler. Rendered
+    kickstarts are kept in LRU keyed by KSAssembler.assemblyKey(), so
+    changed parts or vars never get served from stale entries. Belt is
+    refreshed (see KSAssembler.refresh()) before every request. Keys are
+    computed concurrently, only refresh and rendering on cache miss are
+    serialized"""
+    daemon_threads=True
+    allow_reuse_address=True
+    # listen() backlog, installers tend to come in waves (capped by
+    # net.core.somaxconn)
+    request_queue_size=1024
+
+    def __init__(self,server_address,assembler,cache_size=256,pkg_opts='--nobase'):
+        BaseHTTPServer.HTTPServer.__init__(self,server_address,KSRequestHandler)
+        self.assembler=assembler
+        self.pkg_opts=pkg_opts
+        self.cache=LRUCache(cache_size)
+        # assembly is not meant to run concurrently
+        self.lock=threading.Lock()
+
+    def render(self,template_id,pkg_opts,extra_parts,exclude_parts,legacy_mode,variables):
+        """Return (key,entry) for requested KS, entry['body'] is the text"""
+        with self.lock:
+            # pick up added or removed links, parts and templates
+            self.assembler.refresh()
+        key=self.assembler.assemblyKey(template_id,pkg_opts,False,False,
+                                       extra_parts,exclude_parts,legacy_mode,variables)
+        entry=self.cache.get(key)
+        if entry is not None:
+            return key,entry
+        with self.lock:
+            # another request may have rendered it meanwhile
+            entry=self.cache.get(key)
+            if entry is None:
+                body=''.join(self.assembler.assembleChunks(template_id,pkg_opts,
+                                                           extra_parts=extra_parts,
+                                                           exclude_parts=exclude_parts,
+                                                           legacy_mode=legacy_mode,
+                                                           variables=variables))
+                entry={'body':body,'gzip':None}
+                self.cache.put(key,entry)
+                # start watching template loaded by first request for it
+                self.assembler.refresh()
+        return key,entry
+
+class KSDaemonHandler(SocketServer.StreamRequestHandler):
+    """One command per connection. Request is JSON {"argv": [...],
+    "cwd": ..., "env": {...}} terminated by EOF, reply is a JSON line
+    {"status": exit status, "stderr": ...} followed by command's stdout"""
+
+    def handle(self):
+        data=self.rfile.read()
+        if not data:
+            # just checking whether daemon is alive
+            return
+        try:
+            request=json.loads(data)
+            argv=[_manifest_str(a) for a in request['argv']]
+            cwd=_manifest_str(request['cwd'])
+            env={}
+            for k,v in request['env'].items():
+                env[_manifest_str(k)]=_manifest_str(v)
+        except (ValueError,KeyError,TypeError,AttributeError) as e:
+            status,out,err=2,'',"Bad request: {0}\n".format(e)
+        else:
+            status,out,err=self.server.run(argv,cwd,env)
+        self.wfile.write(json.dumps({'status':status,'stderr':err})+'\n')
+        self.wfile.write(out)
+
+class KSDaemon(SocketServer.UnixStreamServer):
+    """Keeps belts loaded and runs read-only commands (DAEMON_COMMANDS)
+    for clients over Unix socket, see forward_command(). One KSAssembler
+    per belt, refreshed before and after every command. Commands run one at a time,
+    stdout and stderr are captured and client's Environment stands in
+    for meta-var values. Socket is accessible to the owner only"""
 
+    def __init__(self,path):
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            if forward_command(path,None) is not None:
+                raise IOError(errno.EADDRINUSE,"Daemon already running",path)
+            # stale socket of a daemon which is gone
+            os.unlink(path)
+        old_umask=os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self,path,KSDaemonHandler)
+        finally:
+            os.umask(old_umask)
+        self.assemblers={}
+
+    def assembler(self,args):
+        """Loaded KSAssembler for belt args refer to"""
+        belt_file=args.belt_file and os.path.abspath(args.belt_file)
+        key=(os.path.abspath(args.base_dir),args.ignore_dirs,args.no_index,belt_file)
+        a=self.assemblers.get(key)
+        if a is None:
+            a=Assembler(key[0],args.ignore_dirs.split(','),use_index=not args.no_index,belt_file=belt_file)
+            self.assemblers[key]=a
+        a.refresh()
+        return a
+
+    def run(self,argv,cwd,env):
+        """Run command line as if in cwd, returns (status,stdout,stderr)"""
+        out=StringIO()
+        err=StringIO()
+        status=0
+        old_cwd=os.getcwd()
+        old_out,old_err=sys.stdout,sys.stderr
+        sys.stdout,sys.stderr=out,err
+        try:
+            os.chdir(cwd)
+            parser=build_parser()
+            args=parser.parse_args(argv)
+            check_args(parser,args)
+            if not args.command in DAEMON_COMMANDS:
+                print("Command not supported by daemon: {0}".format(args.command),file=sys.stderr)
+                status=2
+            else:
+                a=self.assembler(args)
+                run_command(args,a,env)
+                # start watching templates the command loaded
+                a.refresh()
+        except SystemExit as e:
+            # argparse errors and --help
+            if isinstance(e.code,int):
+                status=e.code
+            elif e.code:
+                print(e.code,file=sys.stderr)
+                status=1
+        except Exception:
+            traceback.print_exc()
+            status=1
+        finally:
+            sys.stdout,sys.stderr=old_out,old_err
+            os.chdir(old_cwd)
+        return status,out.getvalue(),err.getvalue()
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+def accepts_gzip(accept_encoding):
+    """True if Accept-Encoding header value allows gzip: listed (or
+    matched by *) with q>0"""
+    found={}
+    for item in accept_encoding.split(','):
+        params=item.strip().split(';')
+        coding=params[0].strip().lower()
+        if coding=='x-gzip':
+            coding='gzip'
+        q=1.0
+        for param in params[1:]:
+            k,sep,v=param.partition('=')
+            if k.strip().lower()=='q':
+                try:
+                    q=float(v)
+                except ValueError:
+                    q=0.0
+        found[coding]=max(q,found.get(coding,0.0))
+    if found.has_key('gzip'):
+        return found['gzip']>0
+    return found.get('*',0.0)>0
+
+def forward_command(socket_path,argv):
+    """Run command line argv in daemon listening on socket_path, passing
+    on current directory and Environment and copying its output to
+    stdout/stderr. Returns exit status, None when no daemon listens
+    there. argv None just checks for the daemon"""
+    sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error as e:
+        sock.close()
+        if e.errno in (errno.ENOENT,errno.ECONNREFUSED):
+            return None
+        raise
+    if argv is None:
+        sock.close()
+        return 0
+    request={'argv':argv,'cwd':os.getcwd(),'env':dict(os.environ)}
+    sock.sendall(json.dumps(request))
+    sock.shutdown(socket.SHUT_WR)
+    f=sock.makefile('rb')
+    header=json.loads(f.readline())
+    sys.stderr.write(_manifest_str(header['stderr']))
+    while True:
+        chunk=f.read(SINK_BUFSIZE)
+        if not chunk:
+            break
+        sys.stdout.write(chunk)
+    f.close()
+    sock.close()
+    return header['status']
+
+# KSAssembler loaded in the parent, inherited by pool workers
+_worker_assembler=None
+
+def _init_worker(assembler):
+    global _worker_assembler
+    # I/O threads don't survive fork, child starts its own pool
+    assembler._io_pool=None
+    _worker_assembler=assembler
+
+def _assemble_worker(job):
+    return _worker_assembler._runJob(*job)
+
+# mode of newly created files, 0666 less umask, see open_tmp()
+_new_file_mode=None
+
+def open_tmp(path):
+    """Open uniquely named temporary file next to path for writing,
+    returns (file, tmp_path). Renamed over path once complete, so
+    concurrent writers never truncate each other's files. Gets the
+    mode open() would have given it"""
+    global _new_file_mode
+    if _new_file_mode is None:
+        umask=os.umask(0)
+        os.umask(umask)
+        _new_file_mode=0666&~umask
+    p_dir,name=os.path.split(path)
+    fd,tmp_path=tempfile.mkstemp(prefix='.'+name+'.',dir=p_dir or os.curdir)
+    os.fchmod(fd,_new_file_mode)
+    return os.fdopen(fd,'wb'),tmp_path
+
+def replace_file(path,data):
+    """Atomically replace content of path with data"""
+    f,tmp_path=open_tmp(path)
+    try:
+        f.write(data)
+        f.close()
+        os.rename(tmp_path,path)
+    except:
+        f.close()
+        os.unlink(tmp_path)
+        raise
+
+def write_if_changed(path,data):
+    """Write data into path unless file already holds exactly that, so
+    mtime-driven consumers (rsync, make) see no change. Returns True
+    when file was written"""
+    try:
+        if os.stat(path).st_size==len(data):
+            f=open(path,'rb')
+            same=f.read()==data
+            f.close()
+            if same:
+                return False
+    except (IOError,OSError):
+        pass
+    replace_file(path,data)
+    return True
+
+def parse_parts_spec(spec):
+    """Parse parts spec "section1:partA,partB;section2:partD" into
+    {section: [part,...]} dictionary"""
+    parts={}
+    s_chunks=spec.split(';')
+    for s_str in s_chunks:
+        s_chunks_split=s_str.split(':')
+        s=s_chunks_split[0]
+        part_chunks=s_chunks_split[1].split(',')
+        parts[s]=[]
+        for p in part_chunks:
+            parts[s].append(p)
+    return parts
+
+def parse_var_args(var_args):
+    """--var KEY=value arguments into dict, None when there are none"""
+    if not var_args:
+        return None
+    my_vars={}
+    for arg in var_args:
+        if not '=' in arg:
+            raise ValueError("Expected KEY=value: {0}".format(arg))
+        k,v=arg.split('=',1)
+        my_vars[k]=v
+    return my_vars
+
+def _manifest_str(v):
+    if isinstance(v,unicode):
+        return v.encode('utf-8')
+    return str(v)
+
+def load_manifest(path):
+    """Load per-host variables from manifest file. Returns list of
+    (host_id,vars) in manifest order. Format is picked by extension:
+
+    .csv  - header row names variables, first column is host ID
+    .json - {"host_id": {"VAR": "value", ...}, ...}, null values
+            are left out (var stays unset for the host)
+    .ini  - one section per host, options are variables
+    """
+    ext=os.path.splitext(path)[1].lower()
+    hosts=[]
+    if ext=='.csv':
+        f=open(path,'rb')
+        reader=csv.reader(f)
+        header=None
+        for row in reader:
+            if not row:
+                continue
+            if header is None:
+                header=row
+                continue
+            hosts.append((row[0],dict(zip(header,row))))
+        f.close()
+    elif ext=='.json':
+        f=open(path,'r')
+        data=json.load(f,object_pairs_hook=OrderedDict)
+        f.close()
+        for h in data.keys():
+            host_vars={}
+            for k,v in data[h].items():
+                if v is not None:
+                    host_vars[_manifest_str(k)]=_manifest_str(v)
+            hosts.append((_manifest_str(h),host_vars))
+    elif ext in ('.ini','.cfg','.conf'):
+        cp=ConfigParser.RawConfigParser()
+        # keep variable names case
+        cp.optionxform=str
+        # read() would skip missing file silently
+        f=open(path,'r')
+        cp.readfp(f)
+        f.close()
+        for h in cp.sections():
+            hosts.append((h,dict(cp.items(h))))
+    else:
+        raise ValueError("Unknown manifest format: {0}".format(path))
+    return hosts
+
+def _parts_list(v):
+    if isinstance(v,list):
+        return [_manifest_str(p) for p in v]
+    return [p for p in _manifest_str(v).split(',') if p]
+
+def load_operations(path):
+    """Load template operations for KSAssembler.apply(). Returns list of
+    {'op': ..., ...} dicts in file order. Format is picked by extension:
+
+    .json - list of objects:
+            [{"op": "create", "template": "t1", "parts": {"pre": ["p1"]}},
+             {"op": "clone", "src": "t1", "dst": "t2"},
+             {"op": "addpart", "template": "t2", "section": "post", "parts": ["a", "b"]},
+             {"op": "rmpart", "template": "t2", "section": "post", "parts": ["a"]},
+             {"op": "mvpart", "section": "post", "src": "b", "dst": "b2"}]
+    .ini  - one section per operation (section names are just labels)
+            with the same keys, part lists are comma separated and
+            create takes them as <section> = part1,part2
+    """
+    ext=os.path.splitext(path)[1].lower()
+    operations=[]
+    if ext=='.json':
+        f=open(path,'r')
+        data=json.load(f,object_pairs_hook=OrderedDict)
+        f.close()
+        for item in data:
+            op={}
+            for k,v in item.items():
+                k=_manifest_str(k)
+                if k=='parts' and isinstance(v,dict):
+                    op[k]=OrderedDict([(_manifest_str(s),_parts_list(p)) for s,p in v.items()])
+                elif k=='parts':
+                    op[k]=_parts_list(v)
+                else:
+                    op[k]=_manifest_str(v)
+            operations.append(op)
+    elif ext in ('.ini','.cfg','.conf'):
+        cp=ConfigParser.RawConfigParser()
+        cp.optionxform=str
+        # read() would skip missing file silently
+        f=open(path,'r')
+        cp.readfp(f)
+        f.close()
+        for label in cp.sections():
+            op=dict(cp.items(label))
+            if op.get('op')=='create':
+                op['parts']=OrderedDict([(s,_parts_list(op.pop(s))) for s in SECTIONS if op.has_key(s)])
+            elif op.has_key('parts'):
+                op['parts']=_parts_list(op['parts'])
+            operations.append(op)
+    else:
+        raise ValueError("Unknown operations format: {0}".format(path))
+    return operations
+
+def _belt_entry(zf,entry,data):
+    # fixed timestamp, packing the same belt twice gives the same file
+    info=zipfile.ZipInfo(entry,(1980,1,1,0,0,0))
+    info.compress_type=zipfile.ZIP_STORED
+    info.external_attr=0644<<16
+    zf.writestr(info,data)
+
+def pack_belt(conveyor,path):
+    """Write parts and templates of conveyor into packed belt file at
+    path (see KSBelt)"""
+    parts=conveyor.parts
+    templates=conveyor.templates
+    manifest={'version':KSBelt.VERSION,'parts':{},'templates':{},'files':{},
+              'vars':conveyor.getVarDefaults()}
+    f,tmp_path=open_tmp(path)
+    zf=zipfile.ZipFile(f,'w',zipfile.ZIP_STORED)
+    try:
+        # source part -> entry holding its content
+        entries={}
+        def _store(source,entry):
+            _belt_entry(zf,entry,source._text(False,None))
+            manifest['files'][entry]={'sha1':source.getDigest(),'vars':source.scanVars()}
+            entries[source]=entry
+        for s in SECTIONS:
+            pn_list=parts[s].keys()
+            pn_list.sort()
+            manifest['parts'][s]=pn_list
+            for pn in pn_list:
+                _store(parts[s][pn].getSource(),'parts/'+s+'/'+pn)
+        for tid in sorted(templates.db.keys()):
+            template=templates[tid]
+            t_meta={'info':None,'links':{},'vars':template.getVarDefaults()}
+            if template.info:
+                t_meta['info']='templates/'+tid+'/README'
+                _belt_entry(zf,t_meta['info'],template.info)
+            for s in SECTIONS:
+                links={}
+                for p,lpart in template.parts.get(s,{}).items():
+                    source=lpart.getSource()
+                    if not entries.has_key(source):
+                        _store(source,'templates/'+tid+'/'+s+'/'+p)
+                    links[p]=entries[source]
+                t_meta['links'][s]=links
+            manifest['templates'][tid]=t_meta
+        _belt_entry(zf,KSBelt.MANIFEST,json.dumps(manifest,sort_keys=True))
+        zf.close()
+        f.close()
+    except:
+        zf.close()
+        f.close()
+        os.unlink(tmp_path)
+        raise
+    os.rename(tmp_path,path)
+
+def unpack_belt(conveyor,base_dir):
+    """Recreate belt tree under base_dir from conveyor (usually loaded
+    from a packed belt). Links outside of parts DB become plain files"""
+    parts=conveyor.parts
+    templates=conveyor.templates
+    parts_dir=os.path.join(base_dir,'parts')
+    # source part -> path of its file in new tree
+    paths={}
+    for s in SECTIONS:
+        s_dir=os.path.join(parts_dir,s)
+        os.makedirs(s_dir)
+        for pn,part in parts[s].items():
+            source=part.getSource()
+            paths[source]=os.path.join(s_dir,pn)
+            f=open(paths[source],'wb')
+            f.write(source._text(False,None))
+            f.close()
+    if conveyor.getVarDefaults():
+        write_if_changed(os.path.join(base_dir,VARS_FILE),format_vars(conveyor.getVarDefaults()))
+    for tid in templates.db.keys():
+        template=templates[tid]
+        t_dir=os.path.join(base_dir,'templates',tid)
+        for s in SECTIONS:
+            os.makedirs(os.path.join(t_dir,s))
+        if template.info:
+            f=open(os.path.join(t_dir,'README'),'wb')
+            f.write(template.info)
+            f.close()
+        if template.getVarDefaults():
+            write_if_changed(os.path.join(t_dir,VARS_FILE),format_vars(template.getVarDefaults()))
+        for s in template.parts.keys():
+            s_dir=os.path.join(t_dir,s)
+            for p,lpart in template.parts[s].items():
+                source=lpart.getSource()
+                p_path=os.path.join(s_dir,p)
+                if paths.has_key(source):
+                    os.symlink(os.path.relpath(paths[source],s_dir),p_path)
+                else:
+                    f=open(p_path,'wb')
+                    f.write(source._text(False,None))
+                    f.close()
 
 Assembler=KSAssembler
 
-if __name__ == '__main__':
+def build_parser():
     parser=argparse.ArgumentParser()
 
     parser.add_argument('--base-dir','-b',type=str,help='Conveyor belt location',default='.')
     parser.add_argument('--ignore-dirs','-i',type=str,help='List of directories/files to ignore',default='RCS')
+    parser.add_argument('--stats',action='store_const', const=True,default=False,help='Report per-phase timings and I/O counters to stderr')
+    parser.add_argument('--stats-file',type=str,help='Write per-phase timings and I/O counters as JSON into file',default=None)
+    parser.add_argument('--profile',type=str,help='Run under cProfile, dumping stats into file (see pstats)',default=None)
+    parser.add_argument('--no-index',action='store_const', const=True,default=False,help="Don't use/update part metadata index ("+INDEX_FILE+")")
+    parser.add_argument('--belt-file','-B',type=str,help='Load belt from file written by pack instead of base dir (read-only)',default=None)
+    parser.add_argument('--socket',type=str,help='Daemon socket; '+', '.join(DAEMON_COMMANDS)+' are run by daemon listening there (default: $'+SOCKET_ENV+')',default=None)
     subparsers=parser.add_subparsers(dest='command',help='Sub-commands')
 
     parser_assemble=subparsers.add_parser('assemble',help='process template sending resulting KS to stdout')
-    parser_assemble.add_argument('--template-id','-t',type=str,help='Template ID',required=True,default=None)
+    group=parser_assemble.add_mutually_exclusive_group(required=True)
+    group.add_argument('--template-id','-t',type=str,help='Template ID',default=None)
+    group.add_argument('--all',action='store_const', const=True,default=False,help='Assemble all templates into <template>.ks files in --output-dir')
     parser_assemble.add_argument('--packages-opts','-o',type=str,help='Options to pass to %%packages macro',default='--nobase')
     parser_assemble.add_argument('--extra-parts','-e',type=str,help='Extra parts in format: "section1:partA,partB;section2:partD',required=False,default=None)
     parser_assemble.add_argument('--exclude-parts','-x',type=str,help='Exclude parts in format: "section1:partA,partB;section2:partD',required=False,default=None)
@@ -673,6 +3106,55 @@ if __name__ == '__main__':
     parser_assemble.add_argument('--list-all-vars',action='store_const', const=True,default=False,help='Also list all available meta-vars')
     parser_assemble.add_argument('--dry-run',action='store_const', const=True,default=False,help="Don't perform any real action")
     parser_assemble.add_argument('--legacy-mode',action='store_const', const=True,default=False,help="Legacy mode: disable newer features of Anaconda, like %%end tags etc.")
+    parser_assemble.add_argument('--output','-O',type=str,help='Write KS to file instead of stdout',default=None)
+    parser_assemble.add_argument('--cache',action='store_const', const=True,default=False,help='Reuse/store assembled KS in '+CACHE_DIR+' under base dir')
+    parser_assemble.add_argument('--io-workers',type=int,help='Number of threads reading parts ahead of assembly (helps on NFS)',default=1)
+    parser_assemble.add_argument('--output-dir','-D',type=str,help='Directory to write <template>.ks files to (with --all)',default=None)
+    parser_assemble.add_argument('--filter',type=str,help='Regexp filter on template IDs (with --all)',default=None)
+    parser_assemble.add_argument('--jobs','-j',type=int,help='Number of worker processes to render with (with --all)',default=1)
+    parser_assemble.add_argument('--host-vars',type=str,help='File with KEY=value meta-vars, above '+VARS_FILE+' defaults and below Environment',default=None)
+    parser_assemble.add_argument('--var',type=str,action='append',help='KEY=value meta-var overriding all other sources, may repeat',default=None)
+    parser_assemble.add_argument('--part-cache',type=int,help='MiB of translated parts to keep in memory (0 disables, default: '+str(PART_CACHE_MB)+' with --all or daemon, off otherwise)',default=None)
+
+    parser_assemble=subparsers.add_parser('assemble-batch',help='process template once per host from vars manifest, writing <host>.ks files')
+    parser_assemble.add_argument('--template-id','-t',type=str,help='Template ID',required=True,default=None)
+    parser_assemble.add_argument('--manifest','-m',type=str,help='Per-host variables manifest (.csv, .json or .ini)',required=True,default=None)
+    parser_assemble.add_argument('--output-dir','-D',type=str,help='Directory to write <host>.ks files to',required=True,default=None)
+    parser_assemble.add_argument('--packages-opts','-o',type=str,help='Options to pass to %%packages macro',default='--nobase')
+    parser_assemble.add_argument('--extra-parts','-e',type=str,help='Extra parts in format: "section1:partA,partB;section2:partD',required=False,default=None)
+    parser_assemble.add_argument('--exclude-parts','-x',type=str,help='Exclude parts in format: "section1:partA,partB;section2:partD',required=False,default=None)
+    parser_assemble.add_argument('--list-all-vars',action='store_const', const=True,default=False,help='Also list all available meta-vars')
+    parser_assemble.add_argument('--legacy-mode',action='store_const', const=True,default=False,help="Legacy mode: disable newer features of Anaconda, like %%end tags etc.")
+    parser_assemble.add_argument('--jobs','-j',type=int,help='Number of worker processes to render with',default=1)
+    parser_assemble.add_argument('--var',type=str,action='append',help='KEY=value meta-var overriding all other sources, may repeat',default=None)
+    parser_assemble.add_argument('--part-cache',type=int,help='MiB of translated parts to keep in memory (0 disables)',default=PART_CACHE_MB)
+
+    parser_assemble=subparsers.add_parser('serve',help='Serve translated KS over HTTP at /ks/<template>?VAR=value&extra=...&exclude=...')
+    parser_assemble.add_argument('--bind','-a',type=str,help='Address to listen on',default='127.0.0.1')
+    parser_assemble.add_argument('--port','-P',type=int,help='Port to listen on',default=8080)
+    parser_assemble.add_argument('--cache-size',type=int,help='Number of rendered KS to keep in memory',default=256)
+    parser_assemble.add_argument('--packages-opts','-o',type=str,help='Default options to pass to %%packages macro',default='--nobase')
+    parser_assemble.add_argument('--var',type=str,action='append',help='KEY=value meta-var overriding all other sources, may repeat',default=None)
+    parser_assemble.add_argument('--part-cache',type=int,help='MiB of translated parts to keep in memory (0 disables)',default=PART_CACHE_MB)
+
+    parser_assemble=subparsers.add_parser('watch',help='Keep <template>.ks files in output dir up to date, re-rendering templates affected by changes')
+    parser_assemble.add_argument('--output-dir','-D',type=str,help='Directory to write <template>.ks files to',required=True,default=None)
+    parser_assemble.add_argument('--interval',type=float,help='Seconds between polls',default=2.0)
+    parser_assemble.add_argument('--packages-opts','-o',type=str,help='Options to pass to %%packages macro',default='--nobase')
+    parser_assemble.add_argument('--translate',action='store_const', const=True,default=False,help='Translate/extract meta-vars in parts (Using @@VAR@@ form and $VAR environment variable)')
+    parser_assemble.add_argument('--legacy-mode',action='store_const', const=True,default=False,help="Legacy mode: disable newer features of Anaconda, like %%end tags etc.")
+    parser_assemble.add_argument('--var',type=str,action='append',help='KEY=value meta-var overriding all other sources, may repeat',default=None)
+    parser_assemble.add_argument('--part-cache',type=int,help='MiB of translated parts to keep in memory (0 disables)',default=PART_CACHE_MB)
+    parser_assemble.add_argument('filter', type=str, nargs='?', default=None, help='Regexp filter')
+
+    parser_assemble=subparsers.add_parser('pack',help='Pack parts and templates into a single belt file')
+    parser_assemble.add_argument('file',type=str,help='Belt file to write')
+
+    parser_assemble=subparsers.add_parser('unpack',help='Recreate belt tree from belt file')
+    parser_assemble.add_argument('file',type=str,help='Belt file to read')
+    parser_assemble.add_argument('--output-dir','-D',type=str,help='Directory to create parts/ and templates/ in',required=True,default=None)
+
+    parser_assemble=subparsers.add_parser('daemon',help='Keep belts loaded, running '+', '.join(DAEMON_COMMANDS)+' for clients connecting to --socket')
 
     parser_assemble=subparsers.add_parser('init',help='Initialize template FS structure')
     parser_assemble.add_argument('--template-id','-t',type=str,help='Template ID',required=True,default=None)
@@ -682,11 +3164,23 @@ if __name__ == '__main__':
     parser_assemble.add_argument('--section','-S',type=str,help='Kisctart Section name (commands,packages,etc.)',required=True,default=None)
     parser_assemble.add_argument('--parts','-p',type=str,help='List of comma-separated parts',required=True,default=None)
 
+    parser_assemble=subparsers.add_parser('rmpart',help="Remove parts from template's section")
+    parser_assemble.add_argument('--template-id','-t',type=str,help='Template ID',required=True,default=None)
+    parser_assemble.add_argument('--section','-S',type=str,help='Kisctart Section name (commands,packages,etc.)',required=True,default=None)
+    parser_assemble.add_argument('--parts','-p',type=str,help='List of comma-separated parts',required=True,default=None)
+
+    parser_assemble=subparsers.add_parser('apply',help='Run create/clone/addpart/rmpart/mvpart operations from manifest in one go')
+    parser_assemble.add_argument('manifest',type=str,help='Operations manifest (.json or .ini)')
+
     parser_assemble=subparsers.add_parser('mvpart',help='Rename part')
     parser_assemble.add_argument('--section','-S',type=str,help='Kickstart Section name (commands,packages,etc.)',required=True,default=None)
     parser_assemble.add_argument('--src','-s',type=str,help='Current part name',required=True,default=None)
     parser_assemble.add_argument('--dst','-d',type=str,help='New part name',required=True,default=None)
 
+    parser_assemble=subparsers.add_parser('whereused',help='List templates using part')
+    parser_assemble.add_argument('--section','-S',type=str,help='Kickstart Section name (commands,packages,etc.)',required=True,default=None)
+    parser_assemble.add_argument('--part','-p',type=str,help='Part name',required=True,default=None)
+
     parser_assemble=subparsers.add_parser('lsparts',help='List all available parts')
     parser_assemble.add_argument('--list-vars',action='store_const', const=True,default=False,help='Include meta-variable information')
 
@@ -709,71 +3203,194 @@ if __name__ == '__main__':
     for s in SECTIONS:
         parser_assemble.add_argument('--'+s,type=str,help='',required=True,default=None)
 
-    args=parser.parse_args(sys.argv[1:])
+    return parser
+
+def check_args(parser,args):
+    """Reject option combinations argparse can't express"""
+    if args.command=='assemble':
+        if args.all:
+            if not args.output_dir:
+                parser.error("assemble --all needs --output-dir")
+            if args.output:
+                parser.error("assemble --all writes into --output-dir, not --output")
+        elif args.output_dir or args.filter or args.jobs!=1:
+            parser.error("--output-dir, --filter and --jobs need assemble --all")
+
+def run_command(args,assembler=None,variables=None):
+    """Run parsed command line. Uses assembler when given (see daemon),
+    variables (mapping) replace Environment as meta-var values"""
     ignore_dirs=args.ignore_dirs.split(',')
+    if assembler is not None:
+        a=assembler
+    elif args.command=='unpack':
+        a=Assembler(args.base_dir,ignore_dirs,use_index=False,belt_file=args.file)
+    else:
+        a=Assembler(args.base_dir,ignore_dirs,use_index=not args.no_index,belt_file=args.belt_file)
     if args.command == 'assemble':
-        a=Assembler(args.base_dir,ignore_dirs)
         a.setTranslate(args.translate)
+        a.setCache(args.cache)
+        a.setIOWorkers(args.io_workers)
+        a.setVarSources(args.host_vars,parse_var_args(args.var))
+        # pays off only when parts get reused, one template rarely does,
+        # daemon keeps what earlier commands cached
+        if args.part_cache is not None:
+            a.setPartCache(args.part_cache*1024*1024)
+        elif args.all or assembler is not None:
+            if not a.getPartCacheSize():
+                a.setPartCache(PART_CACHE_MB*1024*1024)
+        else:
+            a.setPartCache(0)
 
         if args.extra_parts:
-            extra_parts={}
-            s_chunks=args.extra_parts.split(';')
-            for s_str in s_chunks:
-                s_chunks_split=s_str.split(':')
-                s=s_chunks_split[0]
-                part_chunks=s_chunks_split[1].split(',')
-                extra_parts[s]=[]
-                for p in part_chunks:
-                    extra_parts[s].append(p)
+            extra_parts=parse_parts_spec(args.extra_parts)
         else:
             extra_parts=None
 
         if args.exclude_parts:
-            exclude_parts={}
-            s_chunks=args.exclude_parts.split(';')
-            for s_str in s_chunks:
-                s_chunks_split=s_str.split(':')
-                s=s_chunks_split[0]
-                part_chunks=s_chunks_split[1].split(',')
-                exclude_parts[s]=[]
-                for p in part_chunks:
-                    exclude_parts[s].append(p)
+            exclude_parts=parse_parts_spec(args.exclude_parts)
         else:
             exclude_parts=None
 
-        a.assemble(args.template_id,
-                   args.packages_opts,
-                   var_summary=args.list_all_vars,
-                   dry_run=args.dry_run,
-                   extra_parts=extra_parts,
-                   exclude_parts=exclude_parts,
-                   legacy_mode=args.legacy_mode)
+        if args.all:
+            for ks_path in a.assembleAll(args.output_dir,
+                                         args.packages_opts,
+                                         filter=args.filter,
+                                         jobs=args.jobs,
+                                         var_summary=args.list_all_vars,
+                                         dry_run=args.dry_run,
+                                         extra_parts=extra_parts,
+                                         exclude_parts=exclude_parts,
+                                         legacy_mode=args.legacy_mode,
+                                         variables=variables):
+                print(ks_path)
+        else:
+            if args.output:
+                out=open(args.output,'w')
+            else:
+                out=None
+            a.assemble(args.template_id,
+                       args.packages_opts,
+                       var_summary=args.list_all_vars,
+                       dry_run=args.dry_run,
+                       extra_parts=extra_parts,
+                       exclude_parts=exclude_parts,
+                       legacy_mode=args.legacy_mode,
+                       variables=variables,
+                       out=out)
+            if out is not None:
+                out.close()
+    elif args.command=='assemble-batch':
+        a.setTranslate(True)
+        a.setVarSources(overrides=parse_var_args(args.var))
+        a.setPartCache(args.part_cache*1024*1024)
+        if args.extra_parts:
+            extra_parts=parse_parts_spec(args.extra_parts)
+        else:
+            extra_parts=None
+        if args.exclude_parts:
+            exclude_parts=parse_parts_spec(args.exclude_parts)
+        else:
+            exclude_parts=None
+        a.assembleBatch(args.template_id,
+                        args.packages_opts,
+                        load_manifest(args.manifest),
+                        args.output_dir,
+                        var_summary=args.list_all_vars,
+                        extra_parts=extra_parts,
+                        exclude_parts=exclude_parts,
+                        legacy_mode=args.legacy_mode,
+                        jobs=args.jobs)
+    elif args.command=='serve':
+        a.setTranslate(True)
+        a.setVarSources(overrides=parse_var_args(args.var))
+        a.setPartCache(args.part_cache*1024*1024)
+        server=KSServer((args.bind,args.port),a,args.cache_size,args.packages_opts)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+    elif args.command=='watch':
+        a.setTranslate(args.translate)
+        a.setVarSources(overrides=parse_var_args(args.var))
+        a.setPartCache(args.part_cache*1024*1024)
+        try:
+            a.watch(args.output_dir,args.packages_opts,
+                    filter=args.filter,
+                    interval=args.interval,
+                    legacy_mode=args.legacy_mode)
+        except KeyboardInterrupt:
+            pass
+    elif args.command=='pack':
+        a.pack(args.file)
+    elif args.command=='unpack':
+        a.unpack(args.output_dir)
+    elif args.command=='daemon':
+        socket_path=args.socket or os.environ.get(SOCKET_ENV)
+        if not socket_path:
+            raise ValueError("daemon needs --socket or $"+SOCKET_ENV)
+        daemon=KSDaemon(socket_path)
+        # remove socket on kill as well
+        signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0))
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daemon.server_close()
     elif args.command=='init':
-        a=Assembler(args.base_dir,ignore_dirs)
         a.setup(args.template_id)
     elif args.command=='mvpart':
-        a=Assembler(args.base_dir,ignore_dirs)
         a.mvpart(args.section,args.src,args.dst)
+    elif args.command=='whereused':
+        a.whereused(args.section,args.part)
     elif args.command=='addpart':
-        a=Assembler(args.base_dir,ignore_dirs)
         a.addpart(args.template_id,args.section,args.parts.split(','))
+    elif args.command=='rmpart':
+        a.rmpart(args.template_id,args.section,args.parts.split(','))
+    elif args.command=='apply':
+        a.apply(load_operations(args.manifest))
     elif args.command=='lsparts':
-        a=Assembler(args.base_dir,ignore_dirs)
         a.lsparts(args.list_vars)
     elif args.command=='lstemplates':
-        a=Assembler(args.base_dir,ignore_dirs)
         a.lstemplates(args.filter,args.list_parts,args.list_vars,args.list_all_parts,args.list_info)
     elif args.command=='clone':
-        a=Assembler(args.base_dir,ignore_dirs)
         a.clone(args.src_template_id,args.dst_template_id)
     elif args.command=='create':
-        a=Assembler(args.base_dir,ignore_dirs)
         my_parts={}
         vargs=vars(args)
         for s in SECTIONS:
             my_parts[s]=vargs[s].split(',')
         a.create(args.template_id,my_parts)
     elif args.command=='info':
-        a=Assembler(args.base_dir,ignore_dirs)
         a.info(args.template_id)
+    a.close()
 
+if __name__ == '__main__':
+    parser=build_parser()
+    args=parser.parse_args(sys.argv[1:])
+    check_args(parser,args)
+    socket_path=args.socket or os.environ.get(SOCKET_ENV)
+    if socket_path and args.command in DAEMON_COMMANDS and \
+            not (args.stats or args.stats_file or args.profile):
+        status=forward_command(socket_path,sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+    if args.stats or args.stats_file:
+        stats=KSStats()
+        set_stats(stats)
+    else:
+        stats=None
+    if args.profile:
+        profiler=cProfile.Profile()
+        try:
+            profiler.runcall(run_command,args)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        run_command(args)
+    if stats is not None:
+        if args.stats:
+            stats.report(sys.stderr)
+        if args.stats_file:
+            stats.dump(args.stats_file)
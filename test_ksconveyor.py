@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+"""Regression tests for ksconveyor
+
+  $ python -m unittest test_ksconveyor
+"""
+
+import os
+import os.path
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+import gzip
+import httplib
+from cStringIO import StringIO
+
+import ksconveyor
+
+VARS={'X':'<x>','LONGNAME':'<long>','A':'<a>','AB':'<ab>'}
+LOOKUP=VARS.get
+
+class StreamTokensTest(unittest.TestCase):
+    """stream_tokens() must find the same references as substitute()
+    wherever chunk boundaries fall"""
+    # pieces likely to end up split around chunk boundaries
+    ALPHABET=['@','@@','A','B','_','1',' ','\n','+','/','@@X@@','@@LONGNAME@@','@@@']
+
+    def _streamed(self,chunks):
+        return ''.join([ksconveyor.render(tokens,LOOKUP) for tokens in ksconveyor.stream_tokens(chunks)])
+
+    def test_random_chunks(self):
+        rnd=random.Random(0)
+        for n in xrange(3000):
+            text=''.join([rnd.choice(self.ALPHABET) for i in xrange(rnd.randrange(0,60))])
+            cuts=rnd.sample(xrange(len(text)+1),min(len(text)+1,rnd.randrange(0,8)))
+            cuts.sort()
+            chunks=[text[a:b] for a,b in zip([0]+cuts,cuts+[len(text)])]
+            self.assertEqual(self._streamed(chunks),ksconveyor.substitute(text,LOOKUP),
+                             "chunks: {0!r}".format(chunks))
+
+    def test_every_split(self):
+        text='a@@X@@b@@LONGNAME@@@@A@@@@@AB@@ @@NOPE@@ @@X@'
+        expected=ksconveyor.substitute(text,LOOKUP)
+        for i in xrange(len(text)+1):
+            for j in xrange(i,len(text)+1):
+                chunks=[text[:i],text[i:j],text[j:]]
+                self.assertEqual(self._streamed(chunks),expected,"chunks: {0!r}".format(chunks))
+
+    def test_streamed_part(self):
+        """Parts over STREAM_THRESHOLD are translated chunk by chunk"""
+        tmp_dir=tempfile.mkdtemp()
+        old_threshold=ksconveyor.STREAM_THRESHOLD
+        try:
+            path=os.path.join(tmp_dir,'part')
+            line='host @@X@@ name @@LONGNAME@@ left @@NOPE@@\n'
+            # odd line length makes references cross STREAM_CHUNK boundaries
+            text=line*(3*ksconveyor.STREAM_CHUNK//len(line))
+            f=open(path,'w')
+            f.write(text)
+            f.close()
+            ksconveyor.STREAM_THRESHOLD=1024
+            part=ksconveyor.KSPart(path)
+            part.setTranslate(True)
+            self.assertEqual(part.scanVars(),['LONGNAME','NOPE','X'])
+            self.assertEqual(''.join(part.chunks(VARS)),ksconveyor.substitute(text,LOOKUP))
+        finally:
+            ksconveyor.STREAM_THRESHOLD=old_threshold
+            shutil.rmtree(tmp_dir)
+
+class QuietHandler(ksconveyor.KSRequestHandler):
+    def log_message(self,format,*args):
+        pass
+
+class ServeTest(unittest.TestCase):
+    """KSServer on localhost against a minimal belt"""
+
+    def setUp(self):
+        self.base_dir=tempfile.mkdtemp()
+        for s in ksconveyor.SECTIONS:
+            os.makedirs(os.path.join(self.base_dir,'parts',s))
+            os.makedirs(os.path.join(self.base_dir,'templates','vm',s))
+        f=open(os.path.join(self.base_dir,'parts','commands','network'),'w')
+        f.write('network --hostname=@@HOST@@\n')
+        f.close()
+        os.symlink(os.path.join('..','..','..','parts','commands','network'),
+                   os.path.join(self.base_dir,'templates','vm','commands','network'))
+        a=ksconveyor.KSAssembler(self.base_dir,[],use_index=False)
+        a.setTranslate(True)
+        a.setVarSources()
+        self.server=ksconveyor.KSServer(('127.0.0.1',0),a)
+        self.server.RequestHandlerClass=QuietHandler
+        self.thread=threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.base_dir)
+
+    def _get(self,path,headers={}):
+        conn=httplib.HTTPConnection(*self.server.server_address)
+        try:
+            conn.request('GET',path,headers=headers)
+            resp=conn.getresponse()
+            return resp.status,dict(resp.getheaders()),resp.read()
+        finally:
+            conn.close()
+
+    def test_render(self):
+        status,headers,body=self._get('/ks/vm?HOST=server1')
+        self.assertEqual(status,200)
+        self.assertTrue('network --hostname=server1\n' in body)
+        self.assertEqual(headers['content-length'],str(len(body)))
+
+    def test_not_modified(self):
+        status,headers,body=self._get('/ks/vm?HOST=server1')
+        etag=headers['etag']
+        status,headers,body=self._get('/ks/vm?HOST=server1',{'If-None-Match':etag})
+        self.assertEqual(status,304)
+        self.assertEqual(body,'')
+        # other vars, other KS
+        status,headers,body=self._get('/ks/vm?HOST=server2',{'If-None-Match':etag})
+        self.assertEqual(status,200)
+
+    def test_gzip(self):
+        status,headers,plain=self._get('/ks/vm?HOST=server1')
+        status,gz_headers,body=self._get('/ks/vm?HOST=server1',{'Accept-Encoding':'gzip'})
+        self.assertEqual(status,200)
+        self.assertEqual(gz_headers['content-encoding'],'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(body)).read(),plain)
+        self.assertNotEqual(gz_headers['etag'],headers['etag'])
+        status,headers,body=self._get('/ks/vm?HOST=server1',{'Accept-Encoding':'gzip;q=0'})
+        self.assertFalse(headers.has_key('content-encoding'))
+        self.assertEqual(body,plain)
+
+    def test_refresh(self):
+        """Links added while running are picked up"""
+        self.assertFalse('##PART: post:extra' in self._get('/ks/vm')[2])
+        f=open(os.path.join(self.base_dir,'parts','post','extra'),'w')
+        f.write('echo extra\n')
+        f.close()
+        os.symlink(os.path.join('..','..','..','parts','post','extra'),
+                   os.path.join(self.base_dir,'templates','vm','post','extra'))
+        status,headers,body=self._get('/ks/vm')
+        self.assertEqual(status,200)
+        self.assertTrue('echo extra\n' in body)
+
+    def test_concurrent(self):
+        """Burst of installers connecting before any gets accepted all
+        get their KS"""
+        self.server.shutdown()
+        self.thread.join()
+        conns=[]
+        for n in xrange(200):
+            conn=httplib.HTTPConnection(*self.server.server_address,timeout=5)
+            # waits in listen() backlog until served
+            conn.connect()
+            conns.append(conn)
+        self.thread=threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        for n,conn in enumerate(conns):
+            conn.request('GET','/ks/vm?HOST=server{0}'.format(n))
+        for n,conn in enumerate(conns):
+            resp=conn.getresponse()
+            self.assertEqual(resp.status,200)
+            self.assertTrue('network --hostname=server{0}\n'.format(n) in resp.read())
+            conn.close()
+
+    def test_not_found(self):
+        self.assertEqual(self._get('/ks/nosuchtemplate')[0],404)
+        self.assertEqual(self._get('/ks/vm?extra=post:nosuchpart')[0],404)
+        self.assertEqual(self._get('/other')[0],404)
+
+if __name__=='__main__':
+    unittest.main()